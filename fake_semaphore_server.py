@@ -0,0 +1,199 @@
+"""
+Local stand-in for a Semaphore server, used by the benchmark suite
+Serves REST task create/get/output and templates plus a /ws stream that
+replays the recorded websocket messages from test_data at a chosen rate
+"""
+
+import asyncio
+import collections
+import copy
+import http.server
+import itertools
+import json
+import re
+import threading
+import time
+
+import websockets
+
+from test_data import (
+    REAL_TASK_CREATION_RESPONSE,
+    REAL_TEMPLATES_RESPONSE,
+    REAL_WEBSOCKET_MESSAGES,
+    WEBSOCKET_DIFFERENT_TASK_MESSAGES,
+)
+
+TERMINAL_STATUSES = ('success', 'error', 'stopped')
+
+
+class FakeSemaphoreServer:
+    """Replays REAL_WEBSOCKET_MESSAGES for every task created through the REST API.
+
+    rate            own-task frames per second, None sends as fast as the client reads
+    repeat          how many times the log lines of the recording are replayed per task
+    foreign_ratio   frames of other tasks (WEBSOCKET_DIFFERENT_TASK_MESSAGES) sent per own frame
+    rest_latency    seconds added to every REST response
+    drop_every      close every websocket after this many frames, like a proxy dropping idle sockets
+    """
+
+    def __init__(self, rate=None, repeat=1, foreign_ratio=0, rest_latency=0.0, drop_every=None,
+                 messages=REAL_WEBSOCKET_MESSAGES, foreign_messages=WEBSOCKET_DIFFERENT_TASK_MESSAGES):
+        self.rate = rate
+        self.repeat = repeat
+        self.foreign_ratio = foreign_ratio
+        self.rest_latency = rest_latency
+        self.drop_every = drop_every
+        self.messages = messages
+        self.foreign_messages = foreign_messages
+        self.tasks = {}
+        self.rest_calls = collections.Counter()
+        self.frames_sent = 0
+        self.drops = 0
+        self._task_ids = itertools.count(REAL_TASK_CREATION_RESPONSE['id'])
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._ws_server = None
+        self._http_server = None
+        self._http_thread = None
+
+    @property
+    def api_url(self):
+        return f'http://127.0.0.1:{self._http_server.server_address[1]}/api'
+
+    @property
+    def ws_api_url(self):
+        return f'ws://127.0.0.1:{self._ws_server.sockets[0].getsockname()[1]}/api'
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._ws_server = await websockets.serve(self._serve_websocket, '127.0.0.1', 0)
+        self._http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._request_handler())
+        self._http_thread = threading.Thread(target=self._http_server.serve_forever, daemon=True)
+        self._http_thread.start()
+
+    async def stop(self):
+        self._ws_server.close()
+        await self._ws_server.wait_closed()
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+    def create_task(self, template_id, project_id=1):
+        with self._lock:
+            task = dict(copy.deepcopy(REAL_TASK_CREATION_RESPONSE), id=next(self._task_ids),
+                        template_id=template_id, project_id=project_id)
+            task['log'] = []
+            task['created_at'] = time.monotonic()
+            task['terminal_at'] = None
+            self.tasks[task['id']] = task
+        asyncio.run_coroutine_threadsafe(self._replay(task), self._loop)
+        return {key: value for key, value in task.items() if key in REAL_TASK_CREATION_RESPONSE}
+
+    def _frames(self, task):
+        updates = [msg for msg in self.messages if msg['type'] != 'log']
+        logs = [msg for msg in self.messages if msg['type'] == 'log']
+        terminal = [msg for msg in updates if msg.get('status') in TERMINAL_STATUSES]
+        recording = [msg for msg in updates if msg not in terminal] + logs * self.repeat + terminal
+        foreign = itertools.cycle(self.foreign_messages)
+        for msg in recording:
+            for _ in range(self.foreign_ratio):
+                yield None, next(foreign)
+            yield msg, dict(msg, task_id=task['id'], template_id=task['template_id'])
+
+    async def _replay(self, task):
+        started = time.monotonic()
+        own_frames = 0
+        for original, frame in self._frames(task):
+            if original is not None:
+                own_frames += 1
+                if frame['type'] == 'log':
+                    task['log'].append({'task_id': task['id'], 'time': frame['time'], 'output': frame['output']})
+                else:
+                    task['status'] = frame['status']
+                if self.rate:
+                    delay = started + own_frames / self.rate - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            if not self.rate:
+                # still let reconnecting clients and other replays in between frames
+                await asyncio.sleep(0)
+            await self._broadcast(json.dumps(frame))
+            if original is not None and frame.get('status') in TERMINAL_STATUSES:
+                task['terminal_at'] = time.monotonic()
+
+    async def _broadcast(self, frame):
+        self.frames_sent += 1
+        for client in list(self._clients):
+            try:
+                await client.send(frame)
+            except websockets.ConnectionClosed:
+                self._clients.discard(client)
+        if self.drop_every and self.frames_sent % self.drop_every == 0:
+            self.drops += 1
+            for client in list(self._clients):
+                await client.close()
+
+    async def _serve_websocket(self, websocket):
+        self._clients.add(websocket)
+        try:
+            await websocket.wait_closed()
+        finally:
+            self._clients.discard(websocket)
+
+    def _request_handler(self):
+        server = self
+        task_route = re.compile(r'^/api/project/(\d+)/tasks/(\d+)(/output)?$')
+        template_route = re.compile(r'^/api/project/(\d+)/templates(?:/(\d+))?(?:\?.*)?$')
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=None):
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                time.sleep(server.rest_latency)
+                server.rest_calls['POST tasks'] += 1
+                project = re.match(r'^/api/project/(\d+)/tasks$', self.path)
+                if project is None:
+                    return self._reply(404, {'error': 'Not found'})
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                self._reply(201, server.create_task(request.get('template_id'), int(project.group(1))))
+
+            def do_GET(self):
+                time.sleep(server.rest_latency)
+                task_match = task_route.match(self.path)
+                template_match = template_route.match(self.path)
+                if task_match:
+                    task = server.tasks.get(int(task_match.group(2)))
+                    if task is None:
+                        return self._reply(404, {'error': 'Task not found'})
+                    if task_match.group(3):
+                        server.rest_calls['GET output'] += 1
+                        return self._reply(200, list(task['log']))
+                    server.rest_calls['GET task'] += 1
+                    return self._reply(200, {key: value for key, value in task.items()
+                                             if key in REAL_TASK_CREATION_RESPONSE})
+                if template_match:
+                    server.rest_calls['GET templates'] += 1
+                    if template_match.group(2) is None:
+                        return self._reply(200, REAL_TEMPLATES_RESPONSE)
+                    for template in REAL_TEMPLATES_RESPONSE:
+                        if template['id'] == int(template_match.group(2)):
+                            return self._reply(200, template)
+                return self._reply(404, {'error': 'Not found'})
+
+        return Handler
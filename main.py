@@ -1,81 +1,426 @@
 import asyncio
+import atexit
+import collections
+import contextlib
+import datetime
+import hashlib
+import importlib
+import importlib.util
 import json
 import os
+import random
 import re
+import signal
+import sys
+import threading
+import time
+import uuid
 
-import semaphore_client
-import websockets
-from semaphore_client.model.project_project_id_tasks_get_request import ProjectProjectIdTasksGetRequest
-from semaphore_client.semaphore import project_api
-from websockets import ConnectionClosed
+# semaphore_client and websockets are imported where they are used, and the
+# inputs/configuration below are resolved on first access (see __getattr__),
+# so that importing main stays cheap; test_import_time_budget guards this.
+_LAZY_INPUTS = {
+    'API_KEY': 'INPUT_API_KEY',
+    'API_URL': 'INPUT_API_URL',
+    'WS_API_URL': 'INPUT_WS_API_URL',
+}
 
-API_KEY = os.environ["INPUT_API_KEY"]
-API_URL = os.environ["INPUT_API_URL"]
-WS_API_URL = os.environ["INPUT_WS_API_URL"]
+_configuration = None
 
-configuration = semaphore_client.Configuration(
-    host=API_URL
-)
 
-configuration.api_key['bearer'] = API_KEY
-configuration.api_key_prefix['bearer'] = 'Bearer'
+def make_configuration(host, api_key):
+    import semaphore_client
 
+    configuration = semaphore_client.Configuration(
+        host=host
+    )
 
-def set_github_action_output(output_name, output_value):
-    f = open(os.path.abspath(os.environ["GITHUB_OUTPUT"]), "a")
-    f.write(f'{output_name}={output_value}')
-    f.close()
+    configuration.api_key['bearer'] = api_key
+    configuration.api_key_prefix['bearer'] = 'Bearer'
+    return configuration
 
 
-def start_task(template_id, project_id=1):
-    out = None
-    with semaphore_client.ApiClient(configuration) as api_client:
-        # pass
-        # Create an instance of the API class
+def get_configuration():
+    global _configuration
+    if _configuration is None:
+        _configuration = make_configuration(os.environ["INPUT_API_URL"], os.environ["INPUT_API_KEY"])
+    return _configuration
+
+
+def __getattr__(name):
+    if name in _LAZY_INPUTS:
+        return os.environ[_LAZY_INPUTS[name]]
+    if name == 'configuration':
+        return get_configuration()
+    if name == 'semaphore_client':
+        return importlib.import_module('semaphore_client')
+    if name == 'project_api':
+        return importlib.import_module('semaphore_client.semaphore.project_api')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class GithubOutputWriter:
+    """Keeps ``GITHUB_OUTPUT`` open and publishes outputs in a multiline-safe form.
+
+    ``write`` publishes a value immediately, ``set`` only remembers the latest
+    value per name until ``flush``. Values larger than ``max_value_bytes`` are
+    spilled to a file under ``.semaphore-outputs`` in the workspace and the
+    output is set to that file's path relative to the workspace, which is
+    the same inside the action's container and in later steps. When the file
+    cannot be written the value is truncated to ``max_value_bytes`` instead.
+    """
+
+    def __init__(self, path, max_value_bytes=65536, workspace=None):
+        self.path = os.path.abspath(path)
+        self.max_value_bytes = max_value_bytes
+        self.workspace = workspace or os.environ.get('GITHUB_WORKSPACE') or os.getcwd()
+        self._handle = None
+        self._pending = {}
+
+    def write(self, name, value):
+        self._pending.pop(name, None)
+        self._emit(name, value)
+        self._handle.flush()
+
+    def set(self, name, value):
+        self._pending[name] = value
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for name, value in pending.items():
+            self._emit(name, value)
+        if self._handle is not None:
+            self._handle.flush()
+
+    def close(self):
+        self.flush()
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _emit(self, name, value):
+        if self._handle is None:
+            self._handle = open(self.path, 'a', encoding='utf-8')
+        value = str(value)
+        if len(value.encode('utf-8')) > self.max_value_bytes:
+            value = self._spill(name, value)
+        if '\n' in value or '\r' in value:
+            delimiter = f'ghadelimiter_{uuid.uuid4()}'
+            self._handle.write(f'{name}<<{delimiter}\n{value}\n{delimiter}\n')
+        else:
+            self._handle.write(f'{name}={value}\n')
+
+    def _spill(self, name, value):
+        spill_path = os.path.join('.semaphore-outputs', f'semaphore-output-{name}.txt')
+        try:
+            os.makedirs(os.path.join(self.workspace, '.semaphore-outputs'), exist_ok=True)
+            with open(os.path.join(self.workspace, spill_path), 'w', encoding='utf-8') as f:
+                f.write(value)
+        except OSError as e:
+            print(f"::warning title=Output truncated::Could not write output {name} to {spill_path} ({e}), "
+                  f"publishing its first {self.max_value_bytes} bytes instead")
+            return value.encode('utf-8')[:self.max_value_bytes].decode('utf-8', 'ignore')
+        return spill_path
+
+
+_github_outputs = None
+
+
+def github_outputs():
+    global _github_outputs
+    path = os.path.abspath(os.environ["GITHUB_OUTPUT"])
+    if _github_outputs is None or _github_outputs.path != path:
+        if _github_outputs is not None:
+            _github_outputs.close()
+        _github_outputs = GithubOutputWriter(
+            path,
+            max_value_bytes=int(os.environ.get("INPUT_MAX_OUTPUT_BYTES") or 65536),
+        )
+    return _github_outputs
+
+
+def set_github_action_output(output_name, output_value, defer=False):
+    if defer:
+        github_outputs().set(output_name, output_value)
+    else:
+        github_outputs().write(output_name, output_value)
+
+
+@atexit.register
+def flush_github_action_outputs():
+    if _github_outputs is not None:
+        _github_outputs.flush()
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    """Retries Semaphore API calls that failed with 429/5xx or a connection error.
+
+    Waits for ``Retry-After`` when the server sends one and otherwise backs
+    off exponentially with full jitter. A call gives up, re-raising the last
+    error, once the next wait would take it past ``budget`` seconds.
+    """
+
+    def __init__(self, budget=60.0, backoff_base=0.5, backoff_max=30.0, sleep=time.sleep):
+        self.budget = budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+
+    def call(self, func, *args, **kwargs):
+        deadline = time.monotonic() + self.budget
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None or time.monotonic() + delay > deadline:
+                    raise
+            rest_requests['retries'] += 1
+            self.sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, error, attempt):
+        """Seconds to wait before retrying after ``error``, or None when it must not be retried."""
+        import semaphore_client
+        import urllib3
+
+        if isinstance(error, semaphore_client.ApiException):
+            if error.status not in RETRY_STATUSES:
+                return None
+            retry_after = parse_retry_after((error.headers or {}).get('Retry-After'))
+            if retry_after is not None:
+                return retry_after
+        elif not isinstance(error, (urllib3.exceptions.HTTPError, OSError)):
+            return None
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+_api_retry = None
+
+
+def api_retry():
+    global _api_retry
+    if _api_retry is None:
+        _api_retry = RetryPolicy(budget=float(os.environ.get("INPUT_RETRY_BUDGET") or 60))
+    return _api_retry
+
+
+# How much earlier than our first POST a task may look created on the
+# server and still be taken for ours, to allow for clock differences
+CREATED_TASK_SKEW = datetime.timedelta(seconds=10)
+
+# How long a lookup waits for task POSTs in flight before claiming without them
+CLAIM_WAIT_SECONDS = 30.0
+
+# Task ids are only unique per server, so claims and every per-task registry
+# below are keyed by ``(server, task_id)``; ``server`` is the endpoint's API
+# URL in an endpoint pool run and None otherwise. Claims map to the runs that
+# made them: None for the action's own run, the client's run id in the daemon.
+_claimed_task_ids = {}
+# Guards _claimed_task_ids and counts task POSTs that have not returned yet
+_claim_lock = threading.Condition()
+_posts_in_flight = 0
+
+
+def claim_task(candidates, server=None, run=None, shared=False):
+    """Claim and return the first of ``candidates`` on ``server`` that no other start has claimed, if any.
+
+    A task shows up in the project's task list before the POST creating it
+    returns, so this first waits up to ``CLAIM_WAIT_SECONDS`` for POSTs in
+    flight on other threads; each claims its own task before it counts as
+    done. With ``shared`` only ``run``'s own claims count, so separate runs
+    served by one daemon can attach to the same task.
+    """
+    with _claim_lock:
+        if not _claim_lock.wait_for(lambda: _posts_in_flight == 0, timeout=CLAIM_WAIT_SECONDS):
+            print(f"Task creations still pending after {CLAIM_WAIT_SECONDS:.0f}s, looking for a task without them")
+        for task in candidates:
+            runs = _claimed_task_ids.get((server, task.get('id')), ())
+            if runs and (run in runs or not shared):
+                continue
+            _claimed_task_ids.setdefault((server, task['id']), set()).add(run)
+            return task
+    return None
+
+
+def _same_request(existing, task):
+    """Whether a listed task was started with the template, environment, arguments and limit of ``task``."""
+    return (existing.get('template_id') == task.template_id
+            and _same_json(existing.get('environment'), task.environment)
+            and _same_json(existing.get('arguments'), getattr(task, 'arguments', None))
+            and (existing.get('limit') or '') == (getattr(task, 'limit', None) or ''))
+
+
+def find_created_task(api_instance, project_id, task, since, server=None, run=None):
+    """Claim a task started like ``task`` and created since ``since`` that no other start claimed, if there is one."""
+    rest_requests['lookup'] += 1
+    candidates = []
+    for existing in api_instance.project_project_id_tasks_last_get(project_id):
+        existing = existing.to_dict() if hasattr(existing, 'to_dict') else dict(existing)
+        created = parse_timestamp(existing.get('created'))
+        if _same_request(existing, task) and created is not None and created >= since - CREATED_TASK_SKEW:
+            candidates.append(existing)
+    return claim_task(candidates, server, run)
+
 
-        # api_instance = authentication_api.AuthenticationApi(api_client)
-        # out = api_instance.user_tokens_get()
+def post_task(api_instance, project_id, task, retry=None, server=None, run=None):
+    """Create a task, retrying on transient failures without starting it twice.
 
-        # print(out)
+    A 5xx or a dropped connection does not tell whether Semaphore created
+    the task before the failure, so before posting again the project's most
+    recent tasks are checked for one of this template created since the
+    first attempt. A 429 means the request was refused and is simply resent.
+    """
+    import semaphore_client
 
-        api_instance = project_api.ProjectApi(api_client)
+    first_attempt = None
+    ambiguous = False
+
+    def attempt():
+        global _posts_in_flight
+        nonlocal first_attempt, ambiguous
+        if ambiguous:
+            existing = find_created_task(api_instance, project_id, task, first_attempt, server, run)
+            if existing is not None:
+                print(f"Task {existing['id']} was created before the failed request, not starting another one")
+                return existing
+        first_attempt = first_attempt or datetime.datetime.now(datetime.timezone.utc)
+        created = None
+        with _claim_lock:
+            _posts_in_flight += 1
+        try:
+            created = api_instance.project_project_id_tasks_post(project_id, task)
+            return created
+        except semaphore_client.ApiException as e:
+            ambiguous = e.status != 429
+            raise
+        except Exception:
+            ambiguous = True
+            raise
+        finally:
+            with _claim_lock:
+                if created is not None:
+                    _claimed_task_ids.setdefault((server, created['id']), set()).add(run)
+                _posts_in_flight -= 1
+                _claim_lock.notify_all()
+
+    # one create however many attempts it takes; the retried POSTs count under 'retries'
+    rest_requests['create'] += 1
+    return (retry or api_retry()).call(attempt)
+
+
+# Task statuses that ``reuse_task`` may attach to: ``waiting`` only joins
+# tasks that have not checked out the repository yet, ``running`` also joins
+# ones already underway
+REUSABLE_STATUSES = {
+    'off': (),
+    'waiting': ('waiting',),
+    'running': ('waiting', 'starting', 'running'),
+}
+
+_reused_task_ids = set()
+
+
+def _same_json(first, second):
+    """Compare two task fields that hold JSON text, treating empty values alike."""
+    def normalized(value):
+        if isinstance(value, str):
+            try:
+                value = json.loads(value) if value.strip() else None
+            except ValueError:
+                return value
+        return value or None
+
+    return normalized(first) == normalized(second)
+
+
+def find_reusable_task(api_instance, project_id, task, statuses, server=None, run=None):
+    """Claim the newest unfinished task of the same template, environment, arguments and limit as ``task``, if any.
+
+    Only ``run``'s own claims rule a task out: another run may be following it already.
+    """
+    rest_requests['lookup'] += 1
+    candidates = []
+    for existing in api_retry().call(api_instance.project_project_id_tasks_last_get, project_id):
+        existing = existing.to_dict() if hasattr(existing, 'to_dict') else dict(existing)
+        if existing.get('status') in statuses and _same_request(existing, task):
+            candidates.append(existing)
+    return claim_task(sorted(candidates, key=lambda existing: existing['id'], reverse=True), server, run, shared=True)
+
+
+def start_task(template_id, project_id=1, api_instance=None, limit=None, reuse_task=None, server=None, run=None):
+    """Start ``template_id`` and return the new task's id, or None when it could not be created.
+
+    Uses ``api_instance`` (the run's shared client) when given, otherwise a
+    client of its own. With the ``reuse_task`` input set, an unfinished task
+    of the same template, environment and arguments is attached to instead
+    of starting a duplicate (``reuse_task`` overrides the input). ``limit``
+    restricts the run to an Ansible host pattern. ``server`` is the API URL
+    the task is tracked under in an endpoint pool run, ``run`` the daemon
+    client run that claims it.
+    """
+    import semaphore_client
+    import urllib3
+    from semaphore_client.model.project_project_id_tasks_get_request import ProjectProjectIdTasksGetRequest
+    from semaphore_client.semaphore import project_api
+
+    out = None
+    with contextlib.ExitStack() as stack:
+        if api_instance is None:
+            api_client = stack.enter_context(semaphore_client.ApiClient(get_configuration()))
+            api_instance = project_api.ProjectApi(api_client)
         task = ProjectProjectIdTasksGetRequest(
             template_id=template_id,
             debug=False,
             dry_run=False,
             environment="{}",
         )  # ProjectProjectIdTasksGetRequest |
+        if limit:
+            task.limit = limit
+
+        statuses = REUSABLE_STATUSES[reuse_task or os.environ.get("INPUT_REUSE_TASK") or 'off']
+        existing = None
+        if statuses:
+            try:
+                existing = find_reusable_task(api_instance, project_id, task, statuses, server, run)
+            except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+                print("Exception when looking for a task to reuse, starting a new one: %s\n" % e)
+        if existing is not None:
+            print(f"Template {template_id}: attaching to {existing['status']} task {existing['id']} "
+                  f"instead of starting another")
+            _reused_task_ids.add((server, existing['id']))
+            run_metrics.count('tasks_reused')
 
-        # example passing only required values which don't have defaults set
         try:
             # Starts a job
-            api_response = api_instance.project_project_id_tasks_post(project_id, task)
+            with run_metrics.span('start_task'):
+                api_response = existing or post_task(api_instance, project_id, task, server=server, run=run)
             # pprint(api_response)
             out = api_response['id']
-        except semaphore_client.ApiException as e:
+            run_metrics.observe_task(out, api_response, server)
+        except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
             print("Exception when calling ProjectApi->project_project_id_tasks_post: %s\n" % e)
-
-        # api_instance = default_api.DefaultApi(api_client)
-
-        # example, this endpoint has no required or optional parameters
-        # try:
-        #     # Websocket handler
-        #     thread = api_instance.ws_get(async_req=True, _preload_content=False, _return_http_data_only=False)
-        #     result = thread.get()
-        #     print(result)
-        # except semaphore_client.ApiException as e:
-        #     print("Exception when calling DefaultApi->ws_get: %s\n" % e)
-        # login_body = Login(
-        #     auth="admin",
-        #     password="adminadmin",
-        # ) # Login |
-        #
-        # try:
-        #     # Performs Login
-        #     out = api_instance.auth_login_post(login_body, async_req=False)
-        #     print(out)
-        # except semaphore_client.ApiException as e:
-        #     print("Exception when calling AuthenticationApi->auth_login_post: %s\n" % e)
     return out
 
 
@@ -87,64 +432,2318 @@ def print_hi(name):
 ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 
 
-async def poll_task_updates(run_id=None, api_instance=None, project_id=None):
+class LogSink:
+    """Buffered console writer for task log lines.
+
+    Only the ``output`` text is printed, lines are batched into a single
+    ``write`` per flush, and the ANSI regex runs only on lines that actually
+    contain an escape character. ``mode='raw'`` keeps escape sequences.
+    """
+
+    def __init__(self, stream=None, mode='clean', batch_lines=256):
+        self.stream = stream or sys.stdout
+        self.mode = mode
+        self.batch_lines = batch_lines
+        self.lines = 0
+        self._buffer = []
+
+    def write(self, log_item, prefix=''):
+        output = log_item.get('output') or ''
+        if output and self.mode != 'raw' and '\x1b' in output:
+            output = ansi_escape.sub('', output)
+            log_item['output'] = output
+        if log_item.get('type') == 'update':
+            output = f"Task {log_item.get('task_id')} status: {log_item.get('status', '')}"
+        if not output:
+            return
+        self._buffer.append(prefix + output.rstrip('\n'))
+        self.lines += 1
+        if len(self._buffer) >= self.batch_lines:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._buffer.append('')
+            self.stream.write('\n'.join(self._buffer))
+            self._buffer = []
+        self.stream.flush()
+
+    # console writes block until done, so nothing is ever left to drain
+    backlogged = False
+
+    async def drain(self):
+        pass
+
+
+_log_sink = None
+
+
+def log_sink():
+    global _log_sink
+    if _log_sink is None:
+        _log_sink = LogSink(mode=os.environ.get("INPUT_LOG_MODE") or 'clean')
+    return _log_sink
+
+
+# Ansible failure lines; ERROR! also catches playbook errors that fail before any host runs
+_failure_line = re.compile(r'fatal:|FAILED!|UNREACHABLE!|ERROR!')
+
+
+class LogTail:
+    """The last ``lines`` log lines of a task and its Ansible failure lines.
+
+    Both are kept in fixed-size deques and long lines are cut at
+    ``max_line_chars``, so memory does not grow with the playbook's length.
+    """
+
+    def __init__(self, lines=50, max_failures=20, max_line_chars=2000):
+        self.lines = collections.deque(maxlen=lines)
+        self.failures = collections.deque(maxlen=max_failures)
+        self.failure_count = 0
+        self.max_line_chars = max_line_chars
+
+    def feed(self, output):
+        if not output:
+            return
+        if '\x1b' in output:
+            output = ansi_escape.sub('', output)
+        for line in output.splitlines():
+            if len(line) > self.max_line_chars:
+                line = line[:self.max_line_chars] + '...'
+            self.lines.append(line)
+            if _failure_line.search(line):
+                self.failures.append(line)
+                self.failure_count += 1
+
+
+task_logs = {}
+
+
+def task_log(task_id, server=None):
+    if (server, task_id) not in task_logs:
+        task_logs[server, task_id] = LogTail(lines=int(os.environ.get("INPUT_TAIL_LINES") or 50))
+    return task_logs[server, task_id]
+
+
+def capped_text(lines, max_bytes):
+    """Join ``lines``, dropping the oldest ones until the text fits in ``max_bytes``."""
+    lines = list(lines)
+    size = sum(len(line.encode('utf-8')) + 1 for line in lines)
+    start = 0
+    while size > max_bytes and start < len(lines):
+        size -= len(lines[start].encode('utf-8')) + 1
+        start += 1
+    return '\n'.join(lines[start:])
+
+
+# Every status after which Semaphore will not touch the task again
+TERMINAL_STATUSES = ('success', 'error', 'stopped', 'rejected')
+
+# Header lines Ansible prints at the start of each play, task and handler
+_ansible_header = re.compile(r'(PLAY RECAP|PLAY|TASK|RUNNING HANDLER) (?:\[(.*?)\] )?\*+')
+
+ARCHIVE_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def message_json(message):
+    """A websocket message or REST log item as one line of JSON."""
+    return str(message) if isinstance(message, TaskMessage) else json.dumps(message, default=str)
+
+
+class LogArchive:
+    """Compressed JSONL archive of every message of one task, with a seek index.
+
+    Messages are appended one per line, so memory stays constant. At every
+    Ansible ``PLAY``/``TASK``/``RUNNING HANDLER`` header the compressed
+    stream is ended and a new gzip member (or zstd frame) begun, and the
+    header's byte offset in the archive and its line number are appended
+    to ``<archive>.index.jsonl``. Each member decompresses on its own, so a
+    reader can seek to an offset and start there.
+    """
+
+    def __init__(self, path, compression='gzip'):
+        self.path = path
+        self.index_path = f'{path}.index.jsonl'
+        self.compression = compression
+        self.lines = 0
+        self._file = open(path, 'wb')
+        self._index = open(self.index_path, 'w', encoding='utf-8')
+        self._stream = None
+
+    def write(self, message):
+        output = message.get('output') or ''
+        if output[:1] in ('P', 'T', 'R', '\x1b'):
+            header = _ansible_header.match(ansi_escape.sub('', output) if '\x1b' in output else output)
+            if header:
+                self._end_stream()
+                self._index.write(json.dumps({'kind': header.group(1), 'name': header.group(2),
+                                              'line': self.lines, 'offset': self._file.tell()}) + '\n')
+                self._index.flush()
+        if self._stream is None:
+            self._stream = self._begin_stream()
+        self._stream.write(message_json(message).encode('utf-8') + b'\n')
+        self.lines += 1
+
+    def close(self):
+        self._end_stream()
+        self._file.close()
+        self._index.close()
+
+    def _begin_stream(self):
+        if self.compression == 'zstd':
+            import zstandard
+
+            return zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+        import gzip
+
+        return gzip.GzipFile(fileobj=self._file, mode='wb', compresslevel=6)
+
+    def _end_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+task_archives = {}
+
+
+def task_archive(task_id, server=None):
+    """The task's LogArchive in ``INPUT_LOG_ARCHIVE_DIR``, or None when archiving is off.
+
+    A task of an endpoint pool's ``server`` gets the server's host in its
+    file name, as another server may run a task with the same id.
+    """
+    directory = os.environ.get("INPUT_LOG_ARCHIVE_DIR")
+    if not directory or task_id is None:
+        return None
+    if (server, task_id) not in task_archives:
+        compression = os.environ.get("INPUT_LOG_ARCHIVE_COMPRESSION") or 'gzip'
+        os.makedirs(directory, exist_ok=True)
+        name = f'semaphore-task-{task_id}'
+        if server is not None:
+            host = re.sub(r'[^A-Za-z0-9.-]+', '_', re.sub(r'^\w+://', '', server)).strip('_')
+            name = f'semaphore-task-{host}-{task_id}'
+        path = os.path.join(directory, f'{name}.jsonl{ARCHIVE_SUFFIXES[compression]}')
+        task_archives[server, task_id] = LogArchive(path, compression)
+    return task_archives[server, task_id]
+
+
+# A host's result for the current task: "ok: [web1]", "changed: [web1] => (item=x)", "fatal: [web1]: FAILED! ..."
+_host_result = re.compile(r'(ok|changed|skipping|failed|fatal|rescued|ignored): \[([^\]]+)\]')
+
+
+class AnsibleProfile:
+    """Per-task and per-host durations of a playbook, from the log line timestamps.
+
+    A task runs from its ``TASK``/``RUNNING HANDLER`` header to the next
+    header, and a host's time in it ends at its last result line, which is
+    exact for the default linear strategy. Finished tasks collapse into one
+    entry each and hosts into running totals, so the profile grows with the
+    playbook, not with its output.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.host_seconds = collections.Counter()
+        self.play = None
+        self.recap = False
+        self._current = None
+        self._last_time = None
+
+    def feed(self, output, when):
+        if not output or self.recap:
+            return
+        if '\x1b' in output:
+            output = ansi_escape.sub('', output)
+        for line in output.splitlines():
+            header = _ansible_header.match(line)
+            if header:
+                self._close(when)
+                kind, name = header.groups()
+                if kind == 'PLAY RECAP':
+                    self.recap = True
+                    return
+                if kind == 'PLAY':
+                    self.play = name
+                else:
+                    started = parse_timestamp(when)
+                    if started is not None:
+                        self._current = {'play': self.play, 'task': name, 'handler': kind == 'RUNNING HANDLER',
+                                         'started': started, 'hosts': {}}
+                continue
+            result = _host_result.match(line) if self._current is not None else None
+            if result:
+                finished = parse_timestamp(when)
+                if finished is not None:
+                    self._current['hosts'][result.group(2)] = (finished - self._current['started']).total_seconds()
+        if when:
+            self._last_time = when
+
+    def _close(self, when):
+        current, self._current = self._current, None
+        finished = parse_timestamp(when)
+        if current is None or finished is None:
+            return
+        hosts = current.pop('hosts')
+        current['seconds'] = round((finished - current.pop('started')).total_seconds(), 3)
+        current['hosts'] = len(hosts)
+        if hosts:
+            slowest = max(hosts, key=hosts.get)
+            current['slowest_host'] = slowest
+            current['slowest_host_seconds'] = round(hosts[slowest], 3)
+        for host, seconds in hosts.items():
+            self.host_seconds[host] += seconds
+        self.tasks.append(current)
+
+    def finish(self):
+        """Close the task still running when the stream ended (a failed or stopped run)."""
+        self._close(self._last_time)
+
+    def slowest(self, top=10):
+        return sorted(self.tasks, key=lambda task: task['seconds'], reverse=True)[:top]
+
+    def to_dict(self):
+        return {
+            'tasks': self.tasks,
+            'hosts': {host: round(seconds, 3) for host, seconds in self.host_seconds.most_common()},
+        }
+
+
+task_profiles = {}
+
+
+def task_profile(task_id, server=None):
+    if (server, task_id) not in task_profiles:
+        task_profiles[server, task_id] = AnsibleProfile()
+    return task_profiles[server, task_id]
+
+
+def slow_tasks(results, top=10):
+    """The ``top`` slowest Ansible tasks over every task in ``results``, slowest first."""
+    rows = []
+    for result in results:
+        profile = task_profiles.get((result.get('endpoint'), result['task_id']))
+        if profile is not None:
+            rows += [dict(task, node=result.get('node', result['template_id']), task_id=result['task_id'])
+                     for task in profile.slowest(top)]
+    return sorted(rows, key=lambda row: row['seconds'], reverse=True)[:top]
+
+
+STREAM_DISCONNECTED = 'disconnected'
+STREAM_RECONNECTED = 'reconnected'
+
+_fraction = re.compile(r'(\.\d{6})\d+')
+
+
+def parse_timestamp(value):
+    """Parse a Semaphore timestamp (nanosecond fractions, ``Z`` suffix) into an aware datetime."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(_fraction.sub(r'\1', value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def fast_json_loads():
+    """``orjson.loads`` when orjson is installed, otherwise ``json.loads``."""
+    try:
+        import orjson
+    except ImportError:
+        return json.loads
+    return orjson.loads
+
+
+# Finds a frame's task id without decoding it; a "task_id" key inside a log
+# line is escaped (\"task_id\") and does not match
+_frame_task_id = re.compile(r'"task_id"\s*:\s*(\d+)')
+
+
+def frame_task_id(frame):
+    """The ``task_id`` of a raw websocket frame, or None when it can't be told without decoding."""
+    match = _frame_task_id.search(frame)
+    return int(match.group(1)) if match else None
+
+
+class TaskMessage:
+    """A decoded websocket frame for a tracked task.
+
+    Keeps only the fields the action reads, in slots, together with the raw
+    frame text, and supports the ``get``/``[]`` access used for REST log
+    dicts. ``str()`` gives the frame as JSON: the raw text itself unless a
+    field was rewritten (e.g. ANSI codes stripped from ``output``), so a
+    message published as ``myOutput`` is only encoded when the output is
+    actually written out.
+    """
+
+    __slots__ = ('type', 'task_id', 'status', 'output', 'time', 'start', 'end', 'raw', 'changed')
+
+    FIELDS = ('type', 'task_id', 'status', 'output', 'time', 'start', 'end')
+
+    def __init__(self, raw, data):
+        self.raw = raw
+        self.changed = False
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+
+    @classmethod
+    def decode(cls, frame, loads=json.loads):
+        return cls(frame, loads(frame))
+
+    def copy(self):
+        message = object.__new__(type(self))
+        for slot in self.__slots__:
+            setattr(message, slot, getattr(self, slot))
+        return message
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.to_dict().get(key, default)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return self.to_dict()[key]
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+        self.changed = True
+
+    def to_dict(self):
+        data = json.loads(self.raw)
+        if self.changed:
+            data.update((field, getattr(self, field)) for field in self.FIELDS if field in data)
+        return data
+
+    def __str__(self):
+        return json.dumps(self.to_dict()) if self.changed else self.raw
+
+
+class LogCursor:
+    """Remembers the newest log line a waiter has shown.
+
+    Live lines are only recorded (their timestamps are parsed lazily), lines
+    fetched from REST after a reconnect are filtered to those newer than the
+    cursor, and live lines that repeat backfilled ones are skipped.
+    """
+
+    def __init__(self):
+        self._last_time = None
+        self._last_outputs = set()
+        self._catching_up = False
+
+    def seen(self, log_item):
+        time_value = log_item.get('time')
+        if not time_value:
+            return True
+        if self._catching_up:
+            if not self._is_newer(log_item):
+                return False
+            self._catching_up = False
+        if time_value != self._last_time:
+            self._last_time = time_value
+            self._last_outputs = set()
+        self._last_outputs.add(log_item.get('output'))
+        return True
+
+    def backfill(self, log_items):
+        """Return the REST log items not shown yet, oldest first."""
+        fresh = [log_item for log_item in log_items if self._is_newer(log_item)]
+        oldest = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        fresh.sort(key=lambda log_item: parse_timestamp(log_item.get('time')) or oldest)
+        for log_item in fresh:
+            self.seen(log_item)
+        self._catching_up = True
+        return fresh
+
+    def _is_newer(self, log_item):
+        last = parse_timestamp(self._last_time)
+        when = parse_timestamp(log_item.get('time'))
+        if last is None or when is None or when > last:
+            return True
+        return when == last and log_item.get('output') not in self._last_outputs
+
+
+LOG_OVERFLOW_POLICIES = ('coalesce', 'drop')
+
+# A coalesced message stops growing here; later lines are dropped instead
+MAX_COALESCED_CHARS = 65536
+
+
+class MessageQueue(asyncio.Queue):
+    """A waiter's queue of router messages holding at most ``max_logs`` log messages.
+
+    Status updates, the ``STREAM_*`` markers and the closing ``None`` are
+    always queued. A log message arriving at a full queue is appended to
+    this queue's own copy of the newest queued log message (the router puts
+    the same message into every subscriber's queue) with
+    ``overflow='coalesce'``, or discarded with ``overflow='drop'`` (and when
+    coalescing is not possible); ``dropped`` counts the discarded log lines
+    and ``coalesced`` the merged ones.
+    """
+
+    def __init__(self, max_logs=10000, overflow='coalesce'):
+        super().__init__()
+        self.max_logs = max_logs
+        self.overflow = overflow
+        self.logs = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put_nowait(self, item):
+        if isinstance(item, TaskMessage) and item.type == 'log':
+            if self.logs >= self.max_logs:
+                last = self._queue[-1] if self._queue else None
+                if (self.overflow == 'coalesce' and isinstance(last, TaskMessage) and last.type == 'log'
+                        and len(last.output or '') + len(item.output or '') < MAX_COALESCED_CHARS):
+                    merged = self._queue[-1] = last.copy()
+                    merged['output'] = (last.output or '').rstrip('\n') + '\n' + (item.output or '')
+                    self.coalesced += 1
+                else:
+                    self.dropped += 1
+                return
+            self.logs += 1
+        super().put_nowait(item)
+
+    def _get(self):
+        item = super()._get()
+        if isinstance(item, TaskMessage) and item.type == 'log':
+            self.logs -= 1
+        return item
+
+
+class TaskStreamRouter:
+    """One websocket reader shared by any number of task waiters.
+
+    Every frame from ``/ws`` is dispatched by ``task_id`` into the queues of
+    the waiters subscribed to that task; traffic for other tasks is dropped.
+    When the socket drops each queue receives ``STREAM_DISCONNECTED``, the
+    router reconnects with jittered exponential backoff and then sends
+    ``STREAM_RECONNECTED``. If it gives up (``max_reconnects``) or is closed,
+    queues receive ``None``.
+
+    With ``early_buffer`` the last that many frames of each unsubscribed
+    task are kept and replayed on ``subscribe``, so a router opened before
+    the task is created still sees its first updates. ``stop_buffering``
+    ends this for tasks nobody announced with ``expect``; those stay
+    buffered until they are subscribed. At most ``early_tasks`` tasks are
+    buffered at once, the oldest is forgotten first, and ``first_log_at``
+    only records tasks that were subscribed.
+
+    Waiter queues are ``MessageQueue``s of ``queue_size`` log messages, so a
+    waiter that falls behind a burst of output costs bounded memory and
+    never holds up the reader, which keeps answering pings.
+    """
+
+    def __init__(self, uri=None, api_key=None, max_reconnects=None, backoff_base=0.5, backoff_max=30,
+                 early_buffer=0, queue_size=None, overflow=None, early_tasks=64):
+        self.uri = uri or os.environ["INPUT_WS_API_URL"] + '/ws'
+        self.api_key = api_key or os.environ["INPUT_API_KEY"]
+        self.max_reconnects = max_reconnects
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.received = 0
+        self.bytes_received = 0
+        self._loads = fast_json_loads()
+        self.dropped = 0
+        self.reconnects = 0
+        self.first_log_at = {}
+        self.queue_size = queue_size or int(os.environ.get("INPUT_LOG_QUEUE_SIZE") or 10000)
+        self.overflow = overflow or os.environ.get("INPUT_LOG_OVERFLOW") or 'coalesce'
+        self.early_buffer = early_buffer
+        self.early_tasks = early_tasks
+        self._buffering = bool(early_buffer)
+        # task id -> deque of (arrival time, message) for tasks nobody has subscribed to yet
+        self._early = {}
+        self._expected = set()
+        self._subscribers = {}
+        self._stack = None
+        self._reader = None
+        self._closed = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        websocket = await self._connect()
+        self._reader = asyncio.ensure_future(self._run(websocket))
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        if self._stack is not None:
+            await self._stack.aclose()
+            self._stack = None
+
+    def subscribe(self, task_id):
+        queue = MessageQueue(self.queue_size, self.overflow)
+        self._subscribers.setdefault(task_id, []).append(queue)
+        self._expected.discard(task_id)
+        for arrived, log_item in self._early.pop(task_id, ()):
+            if task_id not in self.first_log_at and log_item.get('type') == 'log':
+                self.first_log_at[task_id] = arrived
+            queue.put_nowait(log_item)
+        if self._closed:
+            queue.put_nowait(None)
+        return queue
+
+    def start_buffering(self):
+        self._buffering = bool(self.early_buffer)
+
+    def stop_buffering(self):
+        self._buffering = False
+        for task_id in [task_id for task_id in self._early if task_id not in self._expected]:
+            del self._early[task_id]
+
+    def expect(self, task_id):
+        """Keep buffering ``task_id``'s frames after ``stop_buffering`` until it is subscribed."""
+        if self.early_buffer and task_id not in self._subscribers:
+            self._expected.add(task_id)
+            self._early.setdefault(task_id, collections.deque(maxlen=self.early_buffer))
+            self._forget_oldest()
+
+    def _buffer(self, task_id, log_item):
+        if task_id not in self._early:
+            self._early[task_id] = collections.deque(maxlen=self.early_buffer)
+            self._forget_oldest()
+        self._early[task_id].append((time.monotonic(), log_item))
+
+    def _forget_oldest(self):
+        while len(self._early) > self.early_tasks:
+            task_id = next(iter(self._early))
+            del self._early[task_id]
+            self._expected.discard(task_id)
+
+    def unsubscribe(self, task_id, queue):
+        queues = self._subscribers.get(task_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            self._subscribers.pop(task_id, None)
+
+    async def _connect(self):
+        import websockets
+
+        if self._stack is not None:
+            await self._stack.aclose()
+        self._stack = contextlib.AsyncExitStack()
+        return await self._stack.enter_async_context(websockets.connect(
+            self.uri,
+            extra_headers={"Authorization": f"Bearer {self.api_key}"}
+        ))
+
+    def _broadcast(self, item):
+        for queues in self._subscribers.values():
+            for queue in queues:
+                queue.put_nowait(item)
+
+    async def _run(self, websocket):
+        try:
+            while True:
+                await self._read(websocket)
+                self._broadcast(STREAM_DISCONNECTED)
+                websocket = await self._reconnect()
+                if websocket is None:
+                    break
+                self._broadcast(STREAM_RECONNECTED)
+        finally:
+            self._closed = True
+            self._broadcast(None)
+
+    async def _read(self, websocket):
+        from websockets.exceptions import ConnectionClosed
+
+        try:
+            while True:
+                frame = await websocket.recv()
+                if isinstance(frame, bytes):
+                    frame = frame.decode('utf-8')
+                self.received += 1
+                self.bytes_received += len(frame)
+                # drop other tasks' traffic before paying for a full decode
+                task_id = frame_task_id(frame)
+                if (task_id is not None and not self._buffering and task_id not in self._subscribers
+                        and task_id not in self._early):
+                    self.dropped += 1
+                    continue
+                log_item = TaskMessage.decode(frame, self._loads)
+                task_id = log_item.task_id
+                queues = self._subscribers.get(task_id)
+                if not queues:
+                    if self._buffering or task_id in self._early:
+                        self._buffer(task_id, log_item)
+                    else:
+                        self.dropped += 1
+                    continue
+                if task_id not in self.first_log_at and log_item.get('type') == 'log':
+                    self.first_log_at[task_id] = time.monotonic()
+                for queue in queues:
+                    queue.put_nowait(log_item)
+        except ConnectionClosed:
+            pass
+
+    async def _reconnect(self):
+        import websockets
+
+        attempt = 0
+        while self.max_reconnects is None or attempt < self.max_reconnects:
+            await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+            attempt += 1
+            try:
+                websocket = await self._connect()
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                print(f"Websocket reconnect attempt {attempt} failed: {e}")
+                continue
+            self.reconnects += 1
+            return websocket
+        return None
+
+
+async def poll_task_updates(run_id=None, api_instance=None, project_id=None, router=None, status_interval=30,
+                            log_prefix='', rest_fallback=True, idle_timeout=None, sink=None, server=None):
+    """Follow a task over the websocket until it reaches a terminal status and return that status.
+
+    Raises ``asyncio.TimeoutError`` once neither a message nor a status
+    change has arrived for ``idle_timeout`` seconds. Messages are written to
+    ``sink`` (the console ``log_sink()`` by default). ``server`` is the
+    endpoint the task's log, profile and archive are kept under.
+    """
+    import semaphore_client
+    import urllib3
+
     def get_task_status(task_id, the_project_id):
         out = None
         try:
             # Get a single task
-            api_response = api_instance.project_project_id_tasks_task_id_get(the_project_id, task_id)
+            rest_requests['status'] += 1
+            api_response = api_retry().call(api_instance.project_project_id_tasks_task_id_get, the_project_id, task_id)
             out = api_response
-        except semaphore_client.ApiException as e:
+        except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
             print("Exception when calling ProjectApi->project_project_id_tasks_task_id_get: %s\n" % e)
 
         return out
 
-    uri = WS_API_URL + '/ws'
+    def get_task_output(task_id, the_project_id):
+        out = []
+        try:
+            # Get task output
+            rest_requests['output'] += 1
+            api_response = api_retry().call(api_instance.project_project_id_tasks_task_id_output_get,
+                                             the_project_id, task_id)
+            out = [item.to_dict() if hasattr(item, 'to_dict') else dict(item) for item in api_response]
+        except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+            print("Exception when calling ProjectApi->project_project_id_tasks_task_id_output_get: %s\n" % e)
+
+        return out
 
-    async with websockets.connect(
-            uri,
-            extra_headers={"Authorization": f"Bearer {API_KEY}"}
-    ) as websocket:
+    def resync(task_id, the_project_id, backfill):
+        return get_task_status(task_id, the_project_id), get_task_output(task_id, the_project_id) if backfill else []
+
+    owns_router = router is None
+    if owns_router:
+        router = await open_task_router('auto' if rest_fallback else 'websocket')
+        if router is None:
+            return await poll_task_rest(run_id, api_instance, project_id, log_prefix=log_prefix,
+                                        idle_timeout=idle_timeout, server=server)
+    queue = router.subscribe(run_id)
+    sink = sink or log_sink()
+    tail = task_log(run_id, server)
+    profile = task_profile(run_id, server)
+    archive = task_archive(run_id, server)
+    cursor = LogCursor()
+    started = time.monotonic()
+
+    # Other tasks' traffic never reaches this queue. If our own task stays quiet
+    # for status_interval seconds, or the websocket drops, its status is checked
+    # over REST in a worker thread so the shared reader is never blocked; at
+    # most one check is pending. After a reconnect the check also backfills the
+    # log lines missed while disconnected, and the queue is held until it has.
+    receiving = None
+    status_check = None
+    backfilling = False
+    final_status = None
+    last_activity = time.monotonic()
+    try:
         while True:
-            try:
+            wait_for = status_interval
+            if idle_timeout:
+                idle = time.monotonic() - last_activity
+                if idle >= idle_timeout:
+                    raise asyncio.TimeoutError(f"no output or status change from task {run_id} for {idle_timeout}s")
+                wait_for = min(wait_for, idle_timeout - idle)
+            if receiving is None:
+                receiving = asyncio.ensure_future(queue.get())
+            if status_check is None:
+                waiting_on = {receiving}
+            elif backfilling:
+                waiting_on = {status_check}
+            else:
+                waiting_on = {receiving, status_check}
+            done, _ = await asyncio.wait(waiting_on, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if status_check is None and time.monotonic() - last_activity >= status_interval:
+                    status_check = asyncio.ensure_future(asyncio.to_thread(resync, run_id, project_id, False))
+                continue
 
-                greeting = await websocket.recv()
-                log_item = json.loads(greeting)
-                log_item['output'] = ansi_escape.sub('', log_item.get('output', ''))
-                status = ''
-                if log_item.get('task_id', 0) == run_id:
-                    print(f"{log_item}")
-                    set_github_action_output('myOutput', str(log_item))
-                    status = log_item.get('status', '')
-                else:
-                    task_object = get_task_status(run_id, project_id)
-                    print(f"{task_object.to_dict()}")
-                    set_github_action_output('myOutput', str(task_object.to_dict()))
-                    status = task_object.to_dict().get('status', '')
+            status = ''
+            if status_check in done:
+                task_object, missed_logs = status_check.result()
+                status_check = None
+                backfilling = False
+                for log_item in cursor.backfill(missed_logs):
+                    sink.write(log_item, log_prefix)
+                    tail.feed(log_item.get('output'))
+                    profile.feed(log_item.get('output'), log_item.get('time'))
+                    if archive:
+                        archive.write(log_item)
+                sink.flush()
+                if sink.backlogged:
+                    await sink.drain()
+                if task_object is not None:
+                    task_dict = task_object.to_dict()
+                    run_metrics.observe_task(run_id, task_dict, server)
+                    set_github_action_output('myOutput', json.dumps(task_dict, default=str), defer=True)
+                    status = task_dict.get('status', '')
+                    sink.write({'type': 'update', 'task_id': run_id, 'status': status}, log_prefix)
+                    sink.flush()
+                    if status and status != final_status:
+                        last_activity = time.monotonic()
+                    final_status = status or final_status
+                    if status in TERMINAL_STATUSES:
+                        break
 
-                if status in ['success', 'error']:
-                    break
+            if receiving not in done:
+                continue
+            log_item = receiving.result()
+            receiving = None
+            if log_item is None:
+                # websocket closed for good
+                break
+            if log_item in (STREAM_DISCONNECTED, STREAM_RECONNECTED):
+                if status_check is None or log_item == STREAM_RECONNECTED:
+                    if status_check is not None:
+                        status_check.cancel()
+                    backfilling = log_item == STREAM_RECONNECTED
+                    status_check = asyncio.ensure_future(asyncio.to_thread(resync, run_id, project_id, backfilling))
+                continue
+            last_activity = time.monotonic()
+            if log_item.get('type') == 'log' and not cursor.seen(log_item):
+                continue
+
+            if log_item.get('type') == 'update':
+                run_metrics.observe_task(run_id, log_item, server)
+            sink.write(log_item, log_prefix)
+            if log_item.get('type') == 'log':
+                tail.feed(log_item.get('output'))
+                profile.feed(log_item.get('output'), log_item.get('time'))
+            if archive:
+                archive.write(log_item)
+            if queue.empty():
+                sink.flush()
+            if sink.backlogged:
+                await sink.drain()
+            # encoded only when the deferred output is flushed
+            set_github_action_output('myOutput', log_item, defer=True)
+            status = log_item.get('status', '')
+            final_status = status or final_status
 
-            except ConnectionClosed:
+            if status in TERMINAL_STATUSES:
                 break
+    finally:
+        for pending in (receiving, status_check):
+            if pending is not None:
+                pending.cancel()
+        router.unsubscribe(run_id, queue)
+        if queue.dropped or queue.coalesced:
+            print(f"{log_prefix}Task {run_id}: output came in faster than it could be written, "
+                  f"{queue.coalesced} log messages merged and {queue.dropped} dropped")
+            run_metrics.count('log_messages_coalesced', queue.coalesced)
+            run_metrics.count('log_messages_dropped', queue.dropped)
+        if owns_router:
+            run_metrics.add_router(router)
+            await router.close()
+        run_metrics.record('poll_task_updates', time.monotonic() - started)
+        profile.finish()
+        if archive:
+            archive.close()
+        sink.flush()
+        set_github_action_output('rest_requests', sum(rest_requests.values()), defer=True)
+        flush_github_action_outputs()
+
+    return final_status
+
+
+rest_requests = collections.Counter()
+
+
+class RunMetrics:
+    """Phase timings and counters for one action run.
+
+    ``span``/``record`` collect durations under a name and ``observe_task``
+    keeps a task's ``created``/``start``/``end`` timestamps as they show up in
+    REST responses and websocket updates, so Semaphore's queue wait (created
+    to start) and run time (start to end) come without extra requests. The
+    websocket's terminal update carries no ``end`` yet, so the moment the
+    terminal status was seen stands in for it. With ``max_samples`` each span
+    keeps only its latest samples.
+    """
+
+    def __init__(self, max_samples=None):
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.spans = collections.defaultdict(lambda: collections.deque(maxlen=max_samples))
+        self.tasks = collections.defaultdict(dict)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name, seconds):
+        self.spans[name].append(seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def add_router(self, router):
+        self.count('messages_received', router.received)
+        self.count('messages_filtered', router.dropped)
+        self.count('reconnects', router.reconnects)
+        self.count('bytes_received', router.bytes_received)
+
+    def observe_task(self, task_id, task_dict, server=None):
+        if task_id is None or not hasattr(task_dict, 'get'):
+            return
+        times = self.tasks[server, task_id]
+        for key in ('created', 'start', 'end'):
+            value = task_dict.get(key)
+            when = parse_timestamp(value) if isinstance(value, str) else None
+            if when is not None:
+                times[key] = when
+        if task_dict.get('status') in TERMINAL_STATUSES and 'end' not in times:
+            times['end'] = datetime.datetime.now(datetime.timezone.utc)
+
+    def task_phases(self, task_id, server=None):
+        times = self.tasks.get((server, task_id), {})
+
+        def between(first, last):
+            if first in times and last in times:
+                return round((times[last] - times[first]).total_seconds(), 3)
+            return None
+
+        return {'queue_seconds': between('created', 'start'), 'run_seconds': between('start', 'end')}
+
+    def snapshot(self, results=()):
+        wall_seconds = time.monotonic() - self.started
+        counters = dict(self.counters, rest_calls=sum(rest_requests.values()))
+        counters['messages_per_second'] = round(counters.get('messages_received', 0) / max(wall_seconds, 1e-6), 1)
+        return {
+            'wall_seconds': round(wall_seconds, 3),
+            'spans': {
+                name: {'count': len(durations), 'total_seconds': round(sum(durations), 3),
+                       'max_seconds': round(max(durations), 3)}
+                for name, durations in self.spans.items()
+            },
+            'counters': counters,
+            'tasks': list(results),
+        }
+
+
+run_metrics = RunMetrics()
+
+
+def _seconds(value):
+    return '' if value is None else f'{value}s'
+
+
+def write_step_summary(metrics, path=None, slow=()):
+    """Append the per-task phase table, run counters and slowest Ansible tasks to ``GITHUB_STEP_SUMMARY``."""
+    path = path or os.environ.get("GITHUB_STEP_SUMMARY")
+    if not path:
+        return
+    counters = metrics['counters']
+    lines = [
+        '### Semaphore tasks',
+        '',
+        '| Template | Task | Status | Create | Queue | Run | Action overhead | First log |',
+        '| --- | --- | --- | --- | --- | --- | --- | --- |',
+    ]
+    for task in metrics['tasks']:
+        lines.append(
+            f"| {task['template_id']} | {task['task_id']} | {task['status']} | {_seconds(task.get('create_seconds'))} "
+            f"| {_seconds(task.get('queue_seconds'))} | {_seconds(task.get('run_seconds'))} "
+            f"| {_seconds(task.get('overhead_seconds'))} | {_seconds(task.get('time_to_first_log'))} |"
+        )
+    lines += [
+        '',
+        '| Messages received | Filtered | Messages/s | Bytes | REST calls | Reconnects | Wall time |',
+        '| --- | --- | --- | --- | --- | --- | --- |',
+        f"| {counters.get('messages_received', 0)} | {counters.get('messages_filtered', 0)} "
+        f"| {counters.get('messages_per_second', 0)} | {counters.get('bytes_received', 0)} "
+        f"| {counters.get('rest_calls', 0)} | {counters.get('reconnects', 0)} | {metrics['wall_seconds']}s |",
+        '',
+    ]
+    if slow:
+        lines += ['### Slowest Ansible tasks', '', format_slow_tasks(slow), '']
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def format_prometheus(metrics):
+    """Render a metrics snapshot in the Prometheus text exposition format."""
+    lines = [
+        '# HELP semaphore_action_wall_seconds Wall time of the action run.',
+        '# TYPE semaphore_action_wall_seconds gauge',
+        f"semaphore_action_wall_seconds {metrics['wall_seconds']}",
+        '# HELP semaphore_action_task_phase_seconds Seconds each task spent in a phase.',
+        '# TYPE semaphore_action_task_phase_seconds gauge',
+    ]
+    for task in metrics['tasks']:
+        for phase in ('create', 'queue', 'run', 'overhead'):
+            value = task.get(f'{phase}_seconds')
+            if value is not None:
+                lines.append(f'semaphore_action_task_phase_seconds{{template="{task["template_id"]}",'
+                             f'task="{task["task_id"]}",status="{task["status"]}",phase="{phase}"}} {value}')
+    for name, value in sorted(metrics['counters'].items()):
+        kind = 'gauge' if name == 'messages_per_second' else 'counter'
+        metric = f'semaphore_action_{name}' if kind == 'gauge' else f'semaphore_action_{name}_total'
+        lines += [f'# TYPE {metric} {kind}', f'{metric} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path, content):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_metrics_file(path, metrics):
+    """Write the metrics as a Prometheus textfile (``.prom``) or as JSON, replacing the file atomically."""
+    if path.endswith('.prom'):
+        content = format_prometheus(metrics)
+    else:
+        content = json.dumps(metrics, indent=2) + '\n'
+    write_atomically(path, content)
+
+
+def format_slow_tasks(rows):
+    """Markdown table of the slowest Ansible tasks, as returned by ``slow_tasks``."""
+    lines = [
+        '| Node | Task | Play | Ansible task | Duration | Hosts | Slowest host |',
+        '| --- | --- | --- | --- | --- | --- | --- |',
+    ]
+    for row in rows:
+        name = f"{row['task']} (handler)" if row['handler'] else row['task']
+        slowest = f"{row['slowest_host']} ({row['slowest_host_seconds']}s)" if 'slowest_host' in row else ''
+        lines.append(f"| {row['node']} | {row['task_id']} | {row['play']} | {name} | {row['seconds']}s "
+                     f"| {row['hosts']} | {slowest} |")
+    return '\n'.join(lines)
+
+
+def next_poll_interval(elapsed, expected_duration=None, min_interval=1.0, max_interval=30.0):
+    """Seconds to wait before the next REST poll of a task that has run for ``elapsed`` seconds.
+
+    Polls fast right after the start and back off as the run gets longer. With
+    an expected duration (e.g. from the template's last run) the interval
+    shrinks towards the expected end and backs off again once it is overdue.
+    """
+    if expected_duration:
+        remaining = expected_duration - elapsed
+        interval = remaining / 4 if remaining > 0 else -remaining / 10
+    else:
+        interval = elapsed / 10
+    return min(max_interval, max(min_interval, interval))
+
+
+def get_template_duration(api_instance, project_id, template_id):
+    """Duration in seconds of the template's last successful run, if Semaphore reports one."""
+    import semaphore_client
+    import urllib3
+
+    try:
+        rest_requests['template'] += 1
+        template = api_retry().call(api_instance.project_project_id_templates_template_id_get, project_id, template_id)
+    except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+        print("Exception when calling ProjectApi->project_project_id_templates_template_id_get: %s\n" % e)
+        return None
+    template = template.to_dict() if hasattr(template, 'to_dict') else dict(template)
+    last_task = template.get('last_task') or {}
+    start, end = parse_timestamp(last_task.get('start')), parse_timestamp(last_task.get('end'))
+    if last_task.get('status') != 'success' or start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+async def poll_task_rest(run_id=None, api_instance=None, project_id=None, expected_duration=None, log_prefix='',
+                         min_interval=1.0, max_interval=30.0, idle_timeout=None, server=None):
+    """Wait for a task by polling the REST API, for networks where the websocket is unreachable.
+
+    Semaphore's output endpoint always returns the whole log, so only lines
+    past the ones already printed are written out. Raises
+    ``asyncio.TimeoutError`` once neither appeared for ``idle_timeout`` seconds.
+    """
+    import semaphore_client
+    import urllib3
+
+    def poll(task_id, the_project_id):
+        task_object, output = None, None
+        try:
+            rest_requests['status'] += 1
+            task_object = api_retry().call(api_instance.project_project_id_tasks_task_id_get, the_project_id, task_id)
+            rest_requests['output'] += 1
+            output = api_retry().call(api_instance.project_project_id_tasks_task_id_output_get, the_project_id, task_id)
+        except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+            print("Exception when polling task %s: %s\n" % (task_id, e))
+        return task_object, output
+
+    sink = log_sink()
+    tail = task_log(run_id, server)
+    profile = task_profile(run_id, server)
+    archive = task_archive(run_id, server)
+    printed = 0
+    final_status = None
+    started = last_activity = time.monotonic()
+    try:
+        while True:
+            task_object, output = await asyncio.to_thread(poll, run_id, project_id)
+            if len(output or []) > printed:
+                last_activity = time.monotonic()
+            for item in (output or [])[printed:]:
+                item = item.to_dict() if hasattr(item, 'to_dict') else dict(item)
+                sink.write(item, log_prefix)
+                tail.feed(item.get('output'))
+                profile.feed(item.get('output'), item.get('time'))
+                if archive:
+                    archive.write(item)
+                printed += 1
+            sink.flush()
+            if task_object is not None:
+                task_dict = task_object.to_dict()
+                run_metrics.observe_task(run_id, task_dict, server)
+                set_github_action_output('myOutput', json.dumps(task_dict, default=str), defer=True)
+                status = task_dict.get('status', '')
+                if status != final_status:
+                    print(f"{log_prefix}Task {run_id} status: {status}")
+                    last_activity = time.monotonic()
+                    if archive:
+                        archive.write(task_dict)
+                final_status = status or final_status
+                if status in TERMINAL_STATUSES:
+                    break
+            if idle_timeout and time.monotonic() - last_activity >= idle_timeout:
+                raise asyncio.TimeoutError(f"no output or status change from task {run_id} for {idle_timeout}s")
+            await asyncio.sleep(next_poll_interval(time.monotonic() - started, expected_duration,
+                                                   min_interval, max_interval))
+    finally:
+        run_metrics.record('poll_task_rest', time.monotonic() - started)
+        profile.finish()
+        if archive:
+            archive.close()
+        sink.flush()
+        set_github_action_output('rest_requests', sum(rest_requests.values()), defer=True)
+        flush_github_action_outputs()
+
+    return final_status
+
+
+async def open_task_router(wait_mode, early_buffer=0, uri=None, api_key=None):
+    """Connect the shared websocket, or return None when waiting should poll REST instead."""
+    import websockets
+
+    if wait_mode == 'rest':
+        return None
+    router = TaskStreamRouter(uri, api_key, early_buffer=early_buffer)
+    try:
+        await router.start()
+    except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+        if wait_mode != 'auto':
+            raise
+        print(f"Websocket {router.uri} unavailable ({e}), polling the REST API instead")
+        return None
+    return router
+
+
+# Tasks a Semaphore server still has to run or is running
+QUEUED_STATUSES = ('waiting', 'starting', 'running')
+
+
+class Endpoint:
+    """One Semaphore server, its API client and its websocket router."""
+
+    def __init__(self, api_url, ws_api_url, api_key, api_instance=None):
+        self.api_url = api_url
+        self.ws_api_url = ws_api_url
+        self.api_key = api_key
+        self.api_instance = api_instance
+        self.router_ready = None
+        self.depth = None
+        self.placed = 0
+
+    def queue_depth(self, project_id):
+        """Waiting and running tasks of the project on this server, or None when it does not answer."""
+        import semaphore_client
+        import urllib3
+
+        try:
+            rest_requests['load'] += 1
+            tasks = RetryPolicy(budget=5).call(self.api_instance.project_project_id_tasks_last_get, project_id)
+        except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+            print(f"Semaphore {self.api_url} unavailable: {e}")
+            return None
+        tasks = [task.to_dict() if hasattr(task, 'to_dict') else dict(task) for task in tasks]
+        return sum(task.get('status') in QUEUED_STATUSES for task in tasks)
+
+
+def parse_endpoints(raw, api_key):
+    """Parse the ``endpoints`` input into Endpoints.
+
+    Either a JSON list of ``{"api_url", "ws_api_url", "api_key"}`` objects
+    or one server per line as ``<api_url> [<ws_api_url>]``. A missing
+    websocket URL is the API URL with ``ws``/``wss`` for ``http``/``https``
+    and a missing key is the ``api_key`` input. Raises ValueError for
+    malformed entries.
+    """
+    raw = raw.strip()
+    if raw.startswith('['):
+        try:
+            entries = json.loads(raw)
+        except ValueError as e:
+            raise ValueError(f"Invalid endpoints: {e}") from None
+    else:
+        entries = [dict(zip(('api_url', 'ws_api_url'), line.split())) for line in raw.splitlines() if line.strip()]
+    endpoints = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('api_url'):
+            raise ValueError(f"Invalid endpoint {entry!r}: expected an api_url")
+        api_url = entry['api_url'].rstrip('/')
+        ws_api_url = (entry.get('ws_api_url') or re.sub(r'^http', 'ws', api_url)).rstrip('/')
+        endpoints.append(Endpoint(api_url, ws_api_url, entry.get('api_key') or api_key))
+    return endpoints
+
+
+class EndpointPool:
+    """Semaphore servers with the same projects; each task goes to the least-loaded one.
+
+    A server's load is its project's waiting and running tasks, checked
+    with ``GET /project/{id}/tasks/last`` at most every ``max_age`` seconds,
+    plus the tasks this run put on it since. A server that fails the check
+    or fails to create a task is passed over until the next check; when no
+    server looks healthy they are all tried in order.
+    """
+
+    def __init__(self, endpoints, max_age=30.0):
+        self.endpoints = endpoints
+        self.max_age = max_age
+        self._checked_at = None
+        self._lock = asyncio.Lock()
+
+    async def ranked(self, project_id):
+        async with self._lock:
+            if self._checked_at is None or time.monotonic() - self._checked_at > self.max_age:
+                depths = await asyncio.gather(*(asyncio.to_thread(endpoint.queue_depth, project_id)
+                                                for endpoint in self.endpoints))
+                for endpoint, depth in zip(self.endpoints, depths):
+                    endpoint.depth, endpoint.placed = depth, 0
+                self._checked_at = time.monotonic()
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.depth is not None]
+        return sorted(healthy, key=lambda endpoint: endpoint.depth + endpoint.placed) or list(self.endpoints)
+
+    async def start(self, template_id, project_id, limit=None):
+        """Start ``template_id`` on the least-loaded server, failing over to the next; returns (endpoint, task_id)."""
+        for endpoint in await self.ranked(project_id):
+            task_id = await asyncio.to_thread(start_task, template_id, project_id, endpoint.api_instance, limit=limit,
+                                              server=endpoint.api_url)
+            if task_id is not None:
+                endpoint.placed += 1
+                print(f"Template {template_id}: task {task_id} started on {endpoint.api_url} "
+                      f"({endpoint.depth} tasks queued there before)")
+                return endpoint, task_id
+            endpoint.depth = None
+            print(f"Template {template_id}: could not start it on {endpoint.api_url}, trying the next server")
+        return None, None
+
+    def open_routers(self, primary_ready, wait_mode, early_buffer=0):
+        """Use ``primary_ready`` for the first server and open a router for each other one."""
+        self.endpoints[0].router_ready = primary_ready
+        for endpoint in self.endpoints[1:]:
+            endpoint.router_ready = asyncio.ensure_future(open_task_router(
+                wait_mode, early_buffer, endpoint.ws_api_url + '/ws', endpoint.api_key
+            ))
+
+    def routers(self):
+        return [endpoint.router_ready for endpoint in self.endpoints if endpoint.router_ready is not None]
+
+    async def close_routers(self):
+        """Close every router but the first server's, which its opener closes."""
+        for endpoint in self.endpoints[1:]:
+            if endpoint.router_ready is None:
+                continue
+            router = await endpoint.router_ready
+            if router is not None:
+                run_metrics.add_router(router)
+                await router.close()
+
+
+def parse_template_ids(raw):
+    """Parse ``myInput`` into a list of template ids and/or template names.
+
+    Accepts a single id or name, a comma/newline separated list (ids may also
+    be separated by spaces) or a JSON list (nested lists, e.g. an id matrix,
+    are flattened). Numeric entries become ints, anything else is kept as a
+    template name for ``resolve_template_ids``.
+    """
+    raw = raw.strip()
+    if raw.startswith('['):
+        pending = [json.loads(raw)]
+        items = []
+        while pending:
+            value = pending.pop(0)
+            if isinstance(value, list):
+                pending[:0] = value
+            else:
+                items.append(value)
+    else:
+        items = []
+        for item in re.split(r'[,\n]+', raw):
+            items.extend(item.split() if re.fullmatch(r'[\d\s]+', item) else [item])
+    items = [str(item).strip() for item in items if str(item).strip()]
+    return [int(item) if item.isdigit() else item for item in items]
+
+
+class TemplateCache:
+    """On-disk map of template names to ids for one Semaphore server and project.
+
+    The file lives in ``cache_dir`` so a workflow can keep it between runs
+    with ``actions/cache``. Names found in a fresh cache cost no request; a
+    miss, or a cache older than ``max_age`` seconds, triggers one bulk
+    ``GET /project/{id}/templates`` sent with ``If-None-Match`` so an
+    unchanged template list is answered with a bodiless 304. When that
+    request fails, names already in the cache are still served and any
+    other name raises ValueError with the error.
+    """
+
+    def __init__(self, cache_dir, api_url, project_id, max_age=86400):
+        digest = hashlib.sha256(api_url.encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f'templates-{digest}-{project_id}.json')
+        self.project_id = project_id
+        self.max_age = max_age
+        self.refreshed = False
+        self.error = None
+        self._data = {'etag': None, 'fetched_at': 0, 'templates': {}}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def stale(self):
+        return time.time() - self._data['fetched_at'] > self.max_age
+
+    def lookup(self, name):
+        if self.stale:
+            self.refresh()
+        template_id = self._data['templates'].get(name)
+        if template_id is None and not self.refreshed:
+            self.refresh()
+            template_id = self._data['templates'].get(name)
+        if template_id is None and self.error is not None:
+            raise ValueError(f"Could not look up template {name!r} in project {self.project_id}: {self.error}")
+        return template_id
+
+    def refresh(self):
+        import semaphore_client
+        import urllib3
+        from semaphore_client.semaphore import project_api
+
+        self.refreshed = True
+        with semaphore_client.ApiClient(get_configuration()) as api_client:
+            if self._data['etag'] and self._data['templates']:
+                api_client.set_default_header('If-None-Match', self._data['etag'])
+            api_instance = project_api.ProjectApi(api_client)
+            try:
+                rest_requests['templates'] += 1
+                response = api_retry().call(
+                    api_instance.project_project_id_templates_get,
+                    self.project_id, sort='name', order='asc', _preload_content=False
+                )
+            except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+                if getattr(e, 'status', None) != 304:
+                    print("Exception when calling ProjectApi->project_project_id_templates_get: %s\n" % e)
+                    self.error = e
+                    return
+            else:
+                self._data['etag'] = response.headers.get('ETag')
+                self._data['templates'] = {
+                    template['name']: template['id'] for template in json.loads(response.data)
+                }
+        self._data['fetched_at'] = time.time()
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f)
+        os.replace(temporary_path, self.path)
+
+
+def resolve_template_ids(templates, project_id, cache=None):
+    """Replace template names with their ids, raising ValueError for unknown names."""
+    if all(isinstance(template, int) for template in templates):
+        return templates
+    if cache is None:
+        cache = TemplateCache(
+            os.environ.get("INPUT_TEMPLATE_CACHE_DIR") or os.path.join(os.getcwd(), '.semaphore-cache'),
+            os.environ["INPUT_API_URL"],
+            project_id,
+        )
+    template_ids = []
+    for template in templates:
+        template_id = template if isinstance(template, int) else cache.lookup(template)
+        if template_id is None:
+            raise ValueError(f"Template {template!r} not found in project {project_id}")
+        template_ids.append(template_id)
+    return template_ids
+
+
+def percentile(values, p):
+    """Nearest-rank ``p``th percentile of the sorted list ``values``."""
+    return values[max(0, min(len(values) - 1, -(-p * len(values) // 100) - 1))]
+
+
+class DurationHistory:
+    """Recent successful run times per template, cached on disk next to the template cache.
+
+    One ``GET /project/{id}/tasks/last`` covers every template and is sent
+    only when the cache is older than ``max_age`` seconds; the action's own
+    successful runs are added as they finish. The last ``keep`` runs of a
+    template give its p50/p95 baseline.
+    """
+
+    def __init__(self, cache_dir, api_url, project_id, max_age=3600, keep=50):
+        digest = hashlib.sha256(api_url.encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f'durations-{digest}-{project_id}.json')
+        self.project_id = project_id
+        self.max_age = max_age
+        self.keep = keep
+        self._data = {'fetched_at': 0, 'templates': {}}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def refresh(self, api_instance):
+        import semaphore_client
+        import urllib3
+
+        if time.time() - self._data['fetched_at'] <= self.max_age:
+            return
+        try:
+            rest_requests['history'] += 1
+            tasks = api_retry().call(api_instance.project_project_id_tasks_last_get, self.project_id)
+        except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+            print("Exception when calling ProjectApi->project_project_id_tasks_last_get: %s\n" % e)
+            return
+        for task in tasks:
+            task = task.to_dict() if hasattr(task, 'to_dict') else dict(task)
+            start, end = parse_timestamp(task.get('start')), parse_timestamp(task.get('end'))
+            if task.get('status') == 'success' and start is not None and end is not None:
+                self.add(task.get('template_id'), task.get('id'), (end - start).total_seconds())
+        self._data['fetched_at'] = time.time()
+
+    def add(self, template_id, task_id, seconds):
+        runs = self._data['templates'].setdefault(str(template_id), {})
+        runs[str(task_id)] = round(seconds, 3)
+        for oldest in sorted(runs, key=int)[:max(0, len(runs) - self.keep)]:
+            del runs[oldest]
+
+    def baseline(self, template_id):
+        runs = sorted(self._data['templates'].get(str(template_id), {}).values())
+        if not runs:
+            return None
+        return {'samples': len(runs), 'p50_seconds': percentile(runs, 50), 'p95_seconds': percentile(runs, 95)}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_atomically(self.path, json.dumps(self._data))
+
+
+_duration_history = None
+
+
+def duration_history():
+    """The run's DurationHistory when the ``baselines`` input is on, otherwise None."""
+    global _duration_history
+    if _duration_history is None and (os.environ.get("INPUT_BASELINES") or 'false').lower() == 'true':
+        _duration_history = DurationHistory(
+            os.environ.get("INPUT_TEMPLATE_CACHE_DIR") or os.path.join(os.getcwd(), '.semaphore-cache'),
+            os.environ["INPUT_API_URL"],
+            int(os.environ["INPUT_PROJECT_ID"]),
+        )
+    return _duration_history
+
+
+# Fewer successful runs than this make no baseline to call a run slow against
+MIN_BASELINE_SAMPLES = 3
+
+PROGRESS_INTERVAL = 30.0
+
+
+async def report_progress(task_id, baseline, log_prefix='', interval=PROGRESS_INTERVAL, server=None):
+    """Print how far a task is through its template's median run time every ``interval`` seconds."""
+    p50, p95 = baseline['p50_seconds'], baseline['p95_seconds']
+    while True:
+        await asyncio.sleep(interval)
+        started = run_metrics.tasks.get((server, task_id), {}).get('start')
+        if started is None:
+            continue
+        elapsed = (datetime.datetime.now(datetime.timezone.utc) - started).total_seconds()
+        if elapsed < p50:
+            print(f"{log_prefix}Task {task_id}: running {elapsed:.0f}s, ~{100 * elapsed / p50:.0f}% "
+                  f"of the usual {p50:.0f}s, ETA {p50 - elapsed:.0f}s")
+        else:
+            print(f"{log_prefix}Task {task_id}: running {elapsed:.0f}s, past the usual {p50:.0f}s (p95 {p95:.0f}s)")
+
+
+def stop_task(api_instance, project_id, task_id):
+    """Ask Semaphore to stop a task the action gave up on, so it frees its runner."""
+    import semaphore_client
+    import urllib3
+
+    try:
+        rest_requests['stop'] += 1
+        # the runner may be killed shortly after a cancellation, so retry only briefly
+        RetryPolicy(budget=5).call(api_instance.project_project_id_tasks_task_id_stop_post, project_id, task_id)
+        print(f"Task {task_id}: stop requested")
+    except (semaphore_client.ApiException, urllib3.exceptions.HTTPError) as e:
+        print("Exception when calling ProjectApi->project_project_id_tasks_task_id_stop_post: %s\n" % e)
+
+
+def task_result(template_id, task_id, status, started, created, first_log_at=None, baseline=None, limit=None,
+                log_prefix='', server=None):
+    """The ``results`` entry of a followed task; ``started``/``created``/``first_log_at`` are monotonic times.
+
+    A successful run slower than ``regression_factor`` times its baseline's
+    p50 is flagged, and one over all hosts is added to the duration history.
+    """
+    duration = time.monotonic() - started
+    phases = run_metrics.task_phases(task_id, server)
+    # whatever Semaphore did not spend queueing or running went to creating and following the task
+    overhead = None
+    if phases['queue_seconds'] is not None and phases['run_seconds'] is not None:
+        overhead = round(max(0.0, duration - phases['queue_seconds'] - phases['run_seconds']), 3)
+    run_seconds = phases['run_seconds'] if phases['run_seconds'] is not None else duration
+    regression = False
+    if baseline is not None and baseline['samples'] >= MIN_BASELINE_SAMPLES and status == 'success':
+        factor = float(os.environ.get("INPUT_REGRESSION_FACTOR") or 1.5)
+        if factor and run_seconds > factor * baseline['p50_seconds']:
+            regression = True
+            print(f"::warning title=Slow Semaphore task::{log_prefix}Task {task_id} of template {template_id} "
+                  f"ran {run_seconds:.0f}s, over {factor}x its p50 of {baseline['p50_seconds']:.0f}s "
+                  f"(p95 {baseline['p95_seconds']:.0f}s)")
+    history = duration_history()
+    # a run limited to some hosts says little about how long the whole template takes
+    reused = (server, task_id) in _reused_task_ids
+    if history is not None and status == 'success' and not limit and not reused:
+        history.add(template_id, task_id, run_seconds)
+    return {
+        'template_id': template_id,
+        'task_id': task_id,
+        'status': status or 'error',
+        'duration': round(duration, 3),
+        'time_to_first_log': round(first_log_at - started, 3) if first_log_at else None,
+        'create_seconds': round(created - started, 3),
+        **phases,
+        'overhead_seconds': overhead,
+        'failures': task_log(task_id, server).failure_count if task_id is not None else 0,
+        'reused': reused,
+        'log_archive': task_archives[server, task_id].path if (server, task_id) in task_archives else None,
+        'baseline_p50_seconds': baseline['p50_seconds'] if baseline else None,
+        'baseline_p95_seconds': baseline['p95_seconds'] if baseline else None,
+        'regression': regression,
+    }
+
+
+async def run_template(template_id, project_id, api_instance, limiter, router_ready, launched=None, log_prefix='',
+                       deadline=None, idle_timeout=None, limit=None, daemon=None, endpoints=None):
+    """Start one template and follow its task to a terminal status.
+
+    Past ``deadline`` (a ``time.monotonic()`` value) or after ``idle_timeout``
+    seconds without output the task is stopped and reported as ``timeout``;
+    when the run is cancelled the task is stopped before the cancellation
+    goes on. Tasks attached to with ``reuse_task`` belong to someone else
+    and are never stopped. With a ``DaemonClient`` as ``daemon`` the task
+    is started, followed and stopped through the daemon instead. With an
+    ``EndpointPool`` as ``endpoints`` it goes to the least-loaded server and
+    is followed over that server's client and router.
+    """
+    async with limiter:
+        started = time.monotonic()
+        task_id = None
+        endpoint = server = None
+        if deadline is None or started < deadline:
+            if daemon is not None:
+                task_id = await daemon.launch(template_id, project_id, limit)
+            elif endpoints is not None:
+                endpoint, task_id = await endpoints.start(template_id, project_id, limit)
+                if endpoint is not None:
+                    api_instance, router_ready = endpoint.api_instance, endpoint.router_ready
+                    server = endpoint.api_url
+            else:
+                task_id = await asyncio.to_thread(start_task, template_id, project_id, api_instance, limit=limit)
+        created = time.monotonic()
+        router = await router_ready
+        if router is not None and task_id is not None:
+            router.expect(task_id)
+        if launched is not None:
+            launched()
+        history = duration_history()
+        baseline = history.baseline(template_id) if history is not None else None
+
+        async def follow():
+            if daemon is not None:
+                return await daemon.follow(task_id, project_id, log_prefix, idle_timeout)
+            if router is not None:
+                return await poll_task_updates(task_id, api_instance, project_id, router=router, log_prefix=log_prefix,
+                                               idle_timeout=idle_timeout, server=server)
+            if baseline is not None:
+                expected_duration = baseline['p50_seconds']
+            else:
+                expected_duration = await asyncio.to_thread(get_template_duration, api_instance, project_id,
+                                                            template_id)
+            return await poll_task_rest(task_id, api_instance, project_id, expected_duration, log_prefix=log_prefix,
+                                        idle_timeout=idle_timeout, server=server)
+
+        async def stop():
+            if daemon is not None:
+                return await daemon.stop(project_id, task_id)
+            return await asyncio.to_thread(stop_task, api_instance, project_id, task_id)
+
+        status = None if deadline is None or started < deadline else 'timeout'
+        if task_id is not None:
+            progress = (asyncio.ensure_future(report_progress(task_id, baseline, log_prefix, server=server))
+                        if baseline else None)
+            try:
+                status = await asyncio.wait_for(follow(), None if deadline is None else deadline - time.monotonic())
+            except asyncio.TimeoutError as e:
+                print(f"{log_prefix}Task {task_id}: giving up, {str(e) or 'deadline reached'}")
+                status = 'timeout'
+                if (server, task_id) not in _reused_task_ids:
+                    await stop()
+            except asyncio.CancelledError:
+                if (server, task_id) not in _reused_task_ids:
+                    await asyncio.shield(stop())
+                raise
+            finally:
+                if progress is not None:
+                    progress.cancel()
+        stream = daemon or router
+        first_log_at = stream.first_log_at.get(task_id) if stream is not None else None
+        result = task_result(template_id, task_id, status, started, created, first_log_at, baseline, limit, log_prefix,
+                             server)
+        if endpoints is not None:
+            result['endpoint'] = endpoint.api_url if endpoint is not None else None
+        return result
+
+
+async def run_templates(template_ids, project_id, api_instance, max_parallel=5, wait_mode='auto', early_buffer=1000,
+                        timeout=None, idle_timeout=None, limit=None, daemon=None, endpoints=None):
+    """Start every template concurrently (at most ``max_parallel`` at once) and wait for all of them.
+
+    All waiters share a single websocket connection, or poll REST when
+    ``wait_mode`` is ``rest`` (or ``auto`` and the websocket is unreachable).
+    The websocket is opened while the first tasks are being created and
+    buffers their early frames until the task ids are known. ``timeout``
+    bounds the whole run in seconds and ``limit`` is passed to every task;
+    see ``run_template``. With a ``daemon`` it holds the websocket instead;
+    with ``endpoints`` every server gets a websocket of its own.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    limiter = asyncio.Semaphore(max(1, max_parallel))
+    router_ready = asyncio.ensure_future(open_task_router('rest' if daemon else wait_mode, early_buffer))
+    if endpoints is not None:
+        endpoints.open_routers(router_ready, wait_mode, early_buffer)
+    remaining = len(template_ids)
+
+    def launched():
+        nonlocal remaining
+        remaining -= 1
+        if remaining == 0:
+            for ready in endpoints.routers() if endpoints is not None else (router_ready,):
+                if ready.done() and ready.result() is not None:
+                    ready.result().stop_buffering()
+
+    log_prefix = '[{}] ' if len(template_ids) > 1 else ''
+    try:
+        return await asyncio.gather(
+            *(run_template(template_id, project_id, api_instance, limiter, router_ready, launched,
+                           log_prefix.format(template_id), deadline, idle_timeout, limit, daemon, endpoints)
+              for template_id in template_ids)
+        )
+    finally:
+        router = await router_ready
+        if router is not None:
+            run_metrics.add_router(router)
+            await router.close()
+        if endpoints is not None:
+            await endpoints.close_routers()
+
+
+def parse_pipeline(raw):
+    """Parse the ``pipeline`` input, inline JSON or the path of a JSON file, into nodes.
+
+    The pipeline maps node names to ``{"template": <id or name>, "needs":
+    [<node>, ...], "limit": <hosts>}`` (``limit`` is optional); a bare
+    template id or name stands for a node without dependencies. Returns
+    ``{name: {'template': ..., 'needs': [...]}}`` in an order where every
+    node comes after its dependencies, and raises ValueError for unknown
+    dependencies or cycles.
+    """
+    raw = raw.strip()
+    if not raw.startswith('{'):
+        with open(raw, 'r', encoding='utf-8') as f:
+            raw = f.read()
+    try:
+        graph = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"Invalid pipeline: {e}") from None
+    if not isinstance(graph, dict) or not graph:
+        raise ValueError("Invalid pipeline: expected a JSON object of nodes")
+    nodes = {}
+    for name, node in graph.items():
+        if not isinstance(node, dict):
+            node = {'template': node}
+        template = node.get('template', name)
+        needs = node.get('needs') or []
+        needs = [needs] if isinstance(needs, str) else [str(parent) for parent in needs]
+        unknown = [parent for parent in needs if parent not in graph]
+        if unknown:
+            raise ValueError(f"Pipeline node {name!r} needs unknown node(s) {', '.join(map(repr, unknown))}")
+        nodes[name] = {'template': int(template) if str(template).isdigit() else template, 'needs': needs}
+        if node.get('limit'):
+            nodes[name]['limit'] = node['limit']
+
+    ordered = {}
+    while len(ordered) < len(nodes):
+        ready = [name for name, node in nodes.items()
+                 if name not in ordered and all(parent in ordered for parent in node['needs'])]
+        if not ready:
+            cycle = sorted(name for name in nodes if name not in ordered)
+            raise ValueError(f"Pipeline has a dependency cycle between {', '.join(map(repr, cycle))}")
+        for name in ready:
+            ordered[name] = nodes[name]
+    return ordered
+
+
+def shard_limit(limit, shards, group_size=None):
+    """Split an Ansible ``limit`` into at most ``shards`` limits that together cover its hosts.
+
+    A list of hosts or patterns (comma, space or newline separated) is cut
+    into contiguous chunks of nearly equal size. A single group pattern is
+    cut into subscript ranges such as ``web[0:49]`` (inclusive, as in
+    Ansible), which needs the group's ``group_size``. Exclusions (``!db``)
+    and intersections (``&prod``) are kept on every shard.
+    """
+    entries = [entry for entry in re.split(r'[,\s]+', limit or '') if entry]
+    modifiers = [entry for entry in entries if entry[0] in '!&']
+    hosts = [entry for entry in entries if entry[0] not in '!&']
+    if not hosts:
+        raise ValueError("Sharding needs a limit listing the hosts or group to split")
+    if len(hosts) == 1:
+        if not group_size:
+            raise ValueError(f"Sharding the single pattern {hosts[0]!r} needs shard_group_size, "
+                             f"the number of hosts in it")
+        pattern, hosts = hosts[0], [None] * group_size
+    else:
+        pattern = None
+    shards = max(1, min(shards, len(hosts)))
+    size, extra = divmod(len(hosts), shards)
+    limits = []
+    start = 0
+    for index in range(shards):
+        end = start + size + (1 if index < extra else 0)
+        chunk = [f'{pattern}[{start}:{end - 1}]'] if pattern else hosts[start:end]
+        limits.append(','.join(chunk + modifiers))
+        start = end
+    return limits
+
+
+def shard_nodes(template_ids, limits):
+    """Pipeline nodes running every template once per limit, named ``<template>_shard<n>``."""
+    return {
+        f'{template_id}_shard{index}': {'template': template_id, 'needs': [], 'limit': limit}
+        for template_id in template_ids
+        for index, limit in enumerate(limits, start=1)
+    }
+
+
+def merge_shards(results):
+    """Fold the results of sharded nodes back into one result per template.
+
+    The template succeeded only if every shard did; otherwise it takes the
+    first shard status that is not ``success``.
+    """
+    merged = {}
+    for result in results:
+        entry = merged.setdefault(result['template_id'], {
+            'template_id': result['template_id'], 'task_ids': [], 'status': 'success', 'duration': 0.0,
+            'failures': 0, 'shards': [],
+        })
+        entry['task_ids'].append(result['task_id'])
+        if entry['status'] == 'success' and result['status'] != 'success':
+            entry['status'] = result['status']
+        entry['duration'] = max(entry['duration'], result['duration'])
+        entry['failures'] += result.get('failures', 0)
+        entry['shards'].append(result)
+    return list(merged.values())
+
+
+def critical_path(results):
+    """Node names of the chain that finished last, following at each step the parent that finished last."""
+    by_node = {result['node']: result for result in results}
+    node = max(results, key=lambda result: result['finished_at'])['node'] if results else None
+    path = []
+    while node is not None:
+        path.append(node)
+        parents = [by_node[parent] for parent in by_node[node]['needs']]
+        node = max(parents, key=lambda result: result['finished_at'])['node'] if parents else None
+    return path[::-1]
+
+
+async def run_pipeline(nodes, project_id, api_instance, max_parallel=5, wait_mode='auto', early_buffer=1000,
+                       timeout=None, idle_timeout=None, daemon=None, endpoints=None):
+    """Run a dependency graph of templates from ``parse_pipeline`` with template ids resolved.
+
+    Every node starts as soon as all of its dependencies succeeded (at most
+    ``max_parallel`` at once) and is skipped when one of them did not. All
+    nodes share one websocket; it keeps buffering early frames until the
+    last node is started or skipped. Results carry the node name, its
+    dependencies and when it became ready and finished, in seconds since
+    the pipeline started. ``timeout`` bounds the whole pipeline in seconds
+    and a ``daemon`` or ``endpoints`` run the nodes' tasks as in ``run_templates``.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    limiter = asyncio.Semaphore(max(1, max_parallel))
+    router_ready = asyncio.ensure_future(open_task_router('rest' if daemon else wait_mode, early_buffer))
+    if endpoints is not None:
+        endpoints.open_routers(router_ready, wait_mode, early_buffer)
+    pipeline_started = time.monotonic()
+    remaining = len(nodes)
+
+    def launched():
+        nonlocal remaining
+        remaining -= 1
+        if remaining == 0:
+            for ready in endpoints.routers() if endpoints is not None else (router_ready,):
+                if ready.done() and ready.result() is not None:
+                    ready.result().stop_buffering()
+
+    async def run_node(name, node):
+        parents = [await runs[parent] for parent in node['needs']]
+        ready_at = time.monotonic() - pipeline_started
+        blocked_by = [parent['node'] for parent in parents if parent['status'] != 'success']
+        if blocked_by:
+            await router_ready
+            launched()
+            print(f"[{name}] skipped: {', '.join(blocked_by)} did not succeed")
+            skipped_at = time.monotonic()
+            result = task_result(node['template'], None, 'skipped', skipped_at, skipped_at)
+        else:
+            result = await run_template(node['template'], project_id, api_instance, limiter, router_ready,
+                                        launched, f'[{name}] ', deadline, idle_timeout, node.get('limit'), daemon,
+                                        endpoints)
+        result.update(node=name, needs=node['needs'], ready_at=round(ready_at, 3),
+                      finished_at=round(time.monotonic() - pipeline_started, 3))
+        return result
+
+    runs = {}
+    for name, node in nodes.items():
+        runs[name] = asyncio.ensure_future(run_node(name, node))
+    try:
+        return await asyncio.gather(*runs.values())
+    finally:
+        for run in runs.values():
+            run.cancel()
+        router = await router_ready
+        if router is not None:
+            run_metrics.add_router(router)
+            await router.close()
+        if endpoints is not None:
+            await endpoints.close_routers()
+
+
+async def cancel_on_signals(coro):
+    """Await ``coro``, cancelling it on SIGTERM/SIGINT (a cancelled workflow) so its tasks get stopped."""
+    run = asyncio.ensure_future(coro)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, run.cancel)
+    try:
+        return await run
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+
+
+DAEMON_SOCKET = '/tmp/semaphore-action.sock'
+# Timing samples the daemon keeps per span name
+DAEMON_METRIC_SAMPLES = 1000
+
+
+def forget_task(task_id, router=None, run=None):
+    """Drop what the run kept about a finished task, so a long-lived daemon does not grow."""
+    for registry in (task_logs, task_profiles, task_archives, run_metrics.tasks):
+        registry.pop((None, task_id), None)
+    if router is not None:
+        router.first_log_at.pop(task_id, None)
+    with _claim_lock:
+        runs = _claimed_task_ids.get((None, task_id), set())
+        runs.discard(run)
+        if not runs:
+            _claimed_task_ids.pop((None, task_id), None)
+    _reused_task_ids.discard((None, task_id))
+
+
+# Unsent bytes a daemon waiter may queue for its client before it waits for the socket
+FORWARD_BUFFER_BYTES = 1 << 20
+
+
+class ForwardingSink:
+    """Stands in for the LogSink of a daemon waiter and sends its messages to the client as JSON lines.
+
+    ``flush`` is forwarded as a ``{"type": "flush"}`` line so the client
+    writes to its console in the same batches a local waiter would. Once
+    more than ``max_buffer`` bytes wait to be sent the sink is
+    ``backlogged`` and the waiter awaits ``drain`` before taking more
+    messages, so a slow client holds up only its own waiter, whose router
+    queue then coalesces or drops as for a slow console.
+    """
+
+    def __init__(self, writer, max_buffer=FORWARD_BUFFER_BYTES):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.lines = 0
+
+    def write(self, log_item, prefix=''):
+        if not self.writer.is_closing():
+            self.writer.write(message_json(log_item).encode('utf-8') + b'\n')
+            self.lines += 1
+
+    def flush(self):
+        if not self.writer.is_closing():
+            self.writer.write(b'{"type": "flush"}\n')
+
+    @property
+    def backlogged(self):
+        transport = self.writer.transport
+        return transport is not None and transport.get_write_buffer_size() > self.max_buffer
+
+    async def drain(self):
+        # a client that went away is noticed by the waiter's hangup read
+        with contextlib.suppress(ConnectionError):
+            await self.writer.drain()
+
+
+class SemaphoreDaemon:
+    """Starts and follows tasks for action steps that connect over a Unix socket.
+
+    Every request shares one ApiClient, whose urllib3 pool keeps the
+    connections to Semaphore open, and one TaskStreamRouter, so a step
+    neither imports the client nor sets up HTTP or the websocket. Each
+    connection carries one JSON request line:
+
+        {"op": "launch", "project_id": 1, "template_id": 44, "limit": null, "reuse_task": "off", "run": "..."}
+            -> {"task_id": 5044, "reused": false}
+        {"op": "wait", "project_id": 1, "task_id": 5044, "idle_timeout": null, "run": "..."}
+            -> the task's messages as JSON lines, then {"type": "result", "status": "success"}
+        {"op": "stop", "project_id": 1, "task_id": 5044}  -> {"stopped": 5044}
+        {"op": "ping"}  -> {"waiting": <tasks being followed>}
+
+    Failures are answered with ``{"error": ...}``. A task stops being
+    followed when its waiter disconnects; the task itself keeps running.
+    ``run`` identifies the client's action run: a run never gets the same
+    task twice, but with ``reuse_task`` it may attach to another run's.
+    """
+
+    def __init__(self, api_instance, router):
+        self.api_instance = api_instance
+        self.router = router
+        self.waiting = 0
+        self.launching = 0
+
+    async def serve(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        os.chmod(path, 0o600)
+        print(f"Semaphore daemon listening on {path}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline() or b'{}')
+            if request.get('op') == 'wait':
+                await self.wait(request, reader, writer)
+            else:
+                writer.write(json.dumps(await self.dispatch(request)).encode('utf-8') + b'\n')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            writer.write(json.dumps({'error': f'bad request: {e}'}).encode('utf-8') + b'\n')
+        finally:
+            with contextlib.suppress(ConnectionError):
+                await writer.drain()
+            writer.close()
+
+    async def dispatch(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'waiting': self.waiting}
+        if op == 'launch':
+            template_id = int(request['template_id'])
+            task_id = None
+            # the new task's id is unknown until the POST returns, so keep every task's frames meanwhile
+            self.launching += 1
+            self.router.start_buffering()
+            try:
+                task_id = await asyncio.to_thread(start_task, template_id, int(request['project_id']),
+                                                  self.api_instance, limit=request.get('limit'),
+                                                  reuse_task=request.get('reuse_task'), run=request.get('run'))
+            finally:
+                self.launching -= 1
+                if task_id is not None:
+                    self.router.expect(task_id)
+                if not self.launching:
+                    self.router.stop_buffering()
+            if task_id is None:
+                return {'error': f'could not start template {template_id}'}
+            return {'task_id': task_id, 'reused': (None, task_id) in _reused_task_ids}
+        if op == 'stop':
+            task_id = int(request['task_id'])
+            await asyncio.to_thread(stop_task, self.api_instance, int(request['project_id']), task_id)
+            return {'stopped': task_id}
+        return {'error': f'unknown op {op!r}'}
+
+    async def wait(self, request, reader, writer):
+        task_id = int(request['task_id'])
+        self.waiting += 1
+        follow = asyncio.ensure_future(poll_task_updates(
+            task_id, self.api_instance, int(request['project_id']), router=self.router,
+            idle_timeout=request.get('idle_timeout'), sink=ForwardingSink(writer)
+        ))
+        # the client sends nothing more, so the read only returns when it disconnects
+        hangup = asyncio.ensure_future(reader.read())
+        try:
+            done, _ = await asyncio.wait({follow, hangup}, return_when=asyncio.FIRST_COMPLETED)
+            if follow in done:
+                try:
+                    reply = {'type': 'result', 'status': follow.result()}
+                except asyncio.TimeoutError as e:
+                    reply = {'type': 'result', 'status': 'timeout', 'error': str(e)}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+        finally:
+            for pending in (follow, hangup):
+                pending.cancel()
+            await asyncio.gather(follow, hangup, return_exceptions=True)
+            self.waiting -= 1
+            forget_task(task_id, self.router, request.get('run'))
+
+
+def daemon_main(path=None):
+    """``python main.py daemon [socket]``: serve ``SemaphoreDaemon`` until SIGTERM/SIGINT."""
+    import semaphore_client
+    from semaphore_client.semaphore import project_api
+
+    path = path or os.environ.get("INPUT_DAEMON_SOCKET") or DAEMON_SOCKET
+    # waiters publish outputs as they go; the daemon has no step to publish them to
+    os.environ.setdefault("GITHUB_OUTPUT", os.devnull)
+    # clients archive what the daemon forwards, and runs attached to one task would share an archive here
+    os.environ.pop("INPUT_LOG_ARCHIVE_DIR", None)
+    configuration = get_configuration()
+    configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize,
+                                                int(os.environ.get("INPUT_MAX_PARALLEL") or 32))
+
+    async def serve(api_instance):
+        global run_metrics
+        # nothing publishes the daemon's metrics, so keep only recent samples instead of one per task forever
+        run_metrics = RunMetrics(max_samples=DAEMON_METRIC_SAMPLES)
+        # frames of unknown tasks are only buffered while a launch is in flight
+        router = TaskStreamRouter(early_buffer=1000)
+        router.stop_buffering()
+        await router.start()
+        try:
+            await SemaphoreDaemon(api_instance, router).serve(path)
+        finally:
+            await router.close()
+
+    with semaphore_client.ApiClient(configuration) as api_client:
+        try:
+            asyncio.run(cancel_on_signals(serve(project_api.ProjectApi(api_client))))
+        except asyncio.CancelledError:
+            print("Semaphore daemon stopped")
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    return 0
+
+
+class DaemonClient:
+    """Starts, follows and stops tasks through the ``SemaphoreDaemon`` listening on ``path``.
+
+    Messages the daemon forwards go through the same log sink, tail,
+    profile and archive as a local waiter's, so outputs are the same.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.first_log_at = {}
+        self.run = uuid.uuid4().hex
+
+    async def request(self, request):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            await writer.drain()
+            return json.loads(await reader.readline() or b'{}')
+        finally:
+            writer.close()
+
+    async def available(self):
+        try:
+            return 'waiting' in await self.request({'op': 'ping'})
+        except (OSError, ValueError):
+            return False
+
+    async def launch(self, template_id, project_id, limit=None):
+        try:
+            reply = await self.request({'op': 'launch', 'project_id': project_id, 'template_id': template_id,
+                                        'limit': limit, 'reuse_task': os.environ.get("INPUT_REUSE_TASK") or 'off',
+                                        'run': self.run})
+        except (OSError, ValueError) as e:
+            reply = {'error': f'daemon unreachable: {e}'}
+        if reply.get('task_id') is None:
+            print(f"Template {template_id}: {reply.get('error')}")
+            return None
+        if reply.get('reused'):
+            _reused_task_ids.add((None, reply['task_id']))
+        return reply['task_id']
+
+    async def stop(self, project_id, task_id):
+        try:
+            await self.request({'op': 'stop', 'project_id': project_id, 'task_id': task_id})
+        except (OSError, ValueError) as e:
+            print(f"Task {task_id}: could not ask the daemon to stop it: {e}")
+
+    async def follow(self, task_id, project_id, log_prefix='', idle_timeout=None):
+        """Stream the task's messages from the daemon and return its final status, like ``poll_task_updates``."""
+        sink = log_sink()
+        tail = task_log(task_id)
+        profile = task_profile(task_id)
+        archive = task_archive(task_id)
+        reader, writer = await asyncio.open_unix_connection(self.path, limit=2 ** 24)
+        try:
+            writer.write(json.dumps({'op': 'wait', 'project_id': project_id, 'task_id': task_id,
+                                     'idle_timeout': idle_timeout, 'run': self.run}).encode('utf-8') + b'\n')
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    print(f"{log_prefix}Task {task_id}: the daemon closed the connection")
+                    return None
+                # without the newline, which would otherwise stay in the message's raw text and myOutput
+                log_item = TaskMessage.decode(line.rstrip(b'\r\n').decode('utf-8'))
+                kind = log_item.get('type')
+                if kind == 'flush':
+                    sink.flush()
+                    continue
+                if kind == 'result':
+                    if log_item.get('status') == 'timeout':
+                        raise asyncio.TimeoutError(log_item.get('error'))
+                    return log_item.get('status')
+                if kind == 'update':
+                    run_metrics.observe_task(task_id, log_item)
+                else:
+                    self.first_log_at.setdefault(task_id, time.monotonic())
+                    tail.feed(log_item.get('output'))
+                    profile.feed(log_item.get('output'), log_item.get('time'))
+                sink.write(log_item, log_prefix)
+                if archive:
+                    archive.write(log_item)
+                set_github_action_output('myOutput', log_item, defer=True)
+        finally:
+            writer.close()
+            profile.finish()
+            if archive:
+                archive.close()
+            sink.flush()
 
 
 def main():
     my_input = os.environ["INPUT_MYINPUT"]
     my_output = f'Hello {my_input}'
     set_github_action_output('myOutput', my_output)
-    if my_input == "world":
+    pipeline = os.environ.get("INPUT_PIPELINE")
+    if my_input == "world" and not pipeline:
         return 0
 
     project_id = int(os.environ["INPUT_PROJECT_ID"])
+    wait_mode = os.environ.get("INPUT_WAIT_MODE") or 'auto'
+    max_parallel = int(os.environ.get("INPUT_MAX_PARALLEL") or 5)
+    timeout = float(os.environ.get("INPUT_TIMEOUT") or 0) or None
+    idle_timeout = float(os.environ.get("INPUT_IDLE_TIMEOUT") or 0) or None
+    limit = os.environ.get("INPUT_LIMIT") or None
+    shards = int(os.environ.get("INPUT_SHARDS") or 1)
+    nodes = None
+    try:
+        extra_endpoints = parse_endpoints(os.environ.get("INPUT_ENDPOINTS") or '', os.environ["INPUT_API_KEY"])
+        if (os.environ.get("INPUT_REUSE_TASK") or 'off') not in REUSABLE_STATUSES:
+            raise ValueError(f"reuse_task must be one of {', '.join(REUSABLE_STATUSES)}")
+        compression = os.environ.get("INPUT_LOG_ARCHIVE_COMPRESSION") or 'gzip'
+        if compression not in ARCHIVE_SUFFIXES:
+            raise ValueError(f"log_archive_compression must be one of {', '.join(ARCHIVE_SUFFIXES)}")
+        if (os.environ.get("INPUT_LOG_OVERFLOW") or 'coalesce') not in LOG_OVERFLOW_POLICIES:
+            raise ValueError(f"log_overflow must be one of {', '.join(LOG_OVERFLOW_POLICIES)}")
+        if compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+            raise ValueError("log_archive_compression zstd needs the zstandard package")
+        if pipeline:
+            nodes = parse_pipeline(pipeline)
+            template_ids = resolve_template_ids([node['template'] for node in nodes.values()], project_id)
+            for node, template_id in zip(nodes.values(), template_ids):
+                node['template'] = template_id
+        else:
+            template_ids = resolve_template_ids(parse_template_ids(my_input), project_id)
+            if shards > 1:
+                group_size = int(os.environ.get("INPUT_SHARD_GROUP_SIZE") or 0)
+                nodes = shard_nodes(template_ids, shard_limit(limit, shards, group_size))
+    except (OSError, ValueError) as e:
+        print(e)
+        set_github_action_output('status', 'error')
+        return 1
+    daemon = None
+    if os.environ.get("INPUT_DAEMON_SOCKET"):
+        daemon = DaemonClient(os.environ["INPUT_DAEMON_SOCKET"])
+        if asyncio.run(daemon.available()):
+            print(f"Running the tasks through the Semaphore daemon on {daemon.path}")
+        else:
+            print(f"No Semaphore daemon on {daemon.path}, running the tasks from this step")
+            daemon = None
     # print_hi('PyCharm')
-    task_id = start_task(int(my_input), project_id)
-    with semaphore_client.ApiClient(configuration) as api_client:
-        # Create an instance of the API class
-        api_instance = project_api.ProjectApi(api_client)
+    with contextlib.ExitStack() as stack:
+        api_instance = None
+        if daemon is None:
+            import semaphore_client
+            from semaphore_client.semaphore import project_api
+
+            # One client for the whole run: its urllib3 pool keeps connections alive
+            # between requests; size it for every task's status and output calls at once
+            configuration = get_configuration()
+            configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, 2 * max_parallel)
+            api_client = stack.enter_context(semaphore_client.ApiClient(configuration))
+            # Create an instance of the API class
+            api_instance = project_api.ProjectApi(api_client)
+        endpoints = None
+        if extra_endpoints and daemon is None:
+            endpoints = EndpointPool([Endpoint(os.environ["INPUT_API_URL"], os.environ["INPUT_WS_API_URL"],
+                                               os.environ["INPUT_API_KEY"], api_instance)] + extra_endpoints)
+            for endpoint in extra_endpoints:
+                endpoint_configuration = make_configuration(endpoint.api_url, endpoint.api_key)
+                endpoint_configuration.connection_pool_maxsize = configuration.connection_pool_maxsize
+                endpoint.api_instance = project_api.ProjectApi(
+                    stack.enter_context(semaphore_client.ApiClient(endpoint_configuration))
+                )
+        history = duration_history()
+        if history is not None:
+            # through the daemon the cached history is all there is
+            if api_instance is not None:
+                history.refresh(api_instance)
+            if nodes is not None:
+                node_templates = [(name, node['template']) for name, node in nodes.items()]
+            else:
+                node_templates = [(template_id, template_id) for template_id in template_ids]
+            baselines = {name: history.baseline(template_id) for name, template_id in node_templates}
+            set_github_action_output('baselines', json.dumps(baselines))
+        try:
+            if nodes is not None:
+                results = asyncio.run(cancel_on_signals(run_pipeline(
+                    nodes, project_id, api_instance, max_parallel, wait_mode, timeout=timeout,
+                    idle_timeout=idle_timeout, daemon=daemon, endpoints=endpoints
+                )))
+            else:
+                results = asyncio.run(cancel_on_signals(run_templates(
+                    template_ids, project_id, api_instance, max_parallel, wait_mode,
+                    timeout=timeout, idle_timeout=idle_timeout, limit=limit, daemon=daemon, endpoints=endpoints
+                )))
+        except asyncio.CancelledError:
+            print("Cancelled, running tasks were asked to stop")
+            set_github_action_output('status', 'cancelled')
+            return 1
 
-        asyncio.run(poll_task_updates(task_id, api_instance, project_id))
+    if pipeline:
+        path = critical_path(results)
+        finished_at = max((result['finished_at'] for result in results), default=0)
+        print(f"Critical path: {' -> '.join(path)} ({finished_at}s)")
+        set_github_action_output('critical_path', json.dumps(path))
+    for result in results:
+        if result['time_to_first_log'] is not None:
+            print(f"Task {result['task_id']}: first log line {result['time_to_first_log']}s after launch")
+        if len(results) > 1:
+            set_github_action_output(f"task_{result.get('node', result['template_id'])}_id", result['task_id'])
+            set_github_action_output(f"task_{result.get('node', result['template_id'])}_status", result['status'])
+    if history is not None:
+        history.save()
+    failed = [result for result in results if result['status'] != 'success']
+    # as in v1, a single template's failed task only fails the step with fail_on_any_error
+    fail_on_any_error = (os.environ.get("INPUT_FAIL_ON_ANY_ERROR") or 'false').lower() == 'true'
+    failing = list(failed) if len(results) > 1 or fail_on_any_error else []
+    if (os.environ.get("INPUT_FAIL_ON_REGRESSION") or 'false').lower() == 'true':
+        regressed = [result for result in results if result['regression']]
+        failed += regressed
+        failing += regressed
+    # The tail and failure lines are capped to stay inline outputs rather than spill files
+    max_bytes = github_outputs().max_value_bytes
+    line_prefix = '[{}] ' if len(results) > 1 else ''
+    tails = [(line_prefix.format(result.get('node', result['template_id'])),
+              task_logs.get((result.get('endpoint'), result['task_id']))) for result in results]
+    set_github_action_output('log_tail', capped_text(
+        (prefix + line for prefix, tail in tails if tail is not None for line in tail.lines), max_bytes))
+    set_github_action_output('failures', capped_text(
+        (prefix + line for prefix, tail in tails if tail is not None for line in tail.failures), max_bytes))
+    set_github_action_output('results', json.dumps(merge_shards(results) if shards > 1 and not pipeline else results))
+    set_github_action_output('status', 'error' if failed else 'success')
+    set_github_action_output('rest_requests', sum(rest_requests.values()))
+    if os.environ.get("INPUT_LOG_ARCHIVE_DIR"):
+        set_github_action_output('log_archive', os.path.abspath(os.environ["INPUT_LOG_ARCHIVE_DIR"]))
+    slow = slow_tasks(results, int(os.environ.get("INPUT_PROFILE_TOP") or 10))
+    if slow:
+        print(format_slow_tasks(slow))
+    set_github_action_output('slow_tasks', json.dumps(slow))
+    if os.environ.get("INPUT_PROFILE_FILE"):
+        keys = {result.get('node', result['template_id']): (result.get('endpoint'), result['task_id'])
+                for result in results}
+        profiles = {node: dict(task_profiles[key].to_dict(), task_id=key[1])
+                    for node, key in keys.items() if key in task_profiles}
+        write_atomically(os.environ["INPUT_PROFILE_FILE"], json.dumps(profiles, indent=2) + '\n')
+    metrics = run_metrics.snapshot(results)
+    set_github_action_output('metrics', json.dumps(metrics))
+    write_step_summary(metrics, slow=slow)
+    if os.environ.get("INPUT_METRICS_FILE"):
+        write_metrics_file(os.environ["INPUT_METRICS_FILE"], metrics)
+    return 1 if failing else 0
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['daemon']:
+        sys.exit(daemon_main(sys.argv[2] if len(sys.argv) > 2 else None))
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite for Semaphore GitHub Action
+Runs the action end to end against the local fake Semaphore server and
+compares throughput, exit latency, memory and REST usage to stored baselines
+
+    SEMAPHORE_BENCHMARKS=1 pytest test_benchmarks.py -s                                   # compare
+    SEMAPHORE_BENCHMARKS=1 BENCHMARK_UPDATE_BASELINES=1 pytest test_benchmarks.py -s      # record
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+import pytest
+
+from fake_semaphore_server import FakeSemaphoreServer
+from test_data import REAL_WEBSOCKET_MESSAGES
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# Allowed regression against the stored baseline before a benchmark fails: messages_per_second may
+# drop by this fraction, the other metrics may grow by it (and by more than 0.05); wall_seconds is
+# only reported
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', '0.25'))
+
+# Metrics where a bigger number is better; every other metric should not grow
+HIGHER_IS_BETTER = {'messages_per_second'}
+
+SCENARIOS = {
+    # Long playbook sent as fast as the action can read it, one foreign frame per own frame
+    'burst': dict(server=dict(repeat=2000, foreign_ratio=1), templates='44'),
+    # Steady log rate on a busy server
+    'paced': dict(server=dict(rate=2000, repeat=300, foreign_ratio=3), templates='44'),
+    # Proxy dropping the websocket every 2000 frames, slow REST
+    'drops': dict(server=dict(repeat=1000, foreign_ratio=1, drop_every=2000, rest_latency=0.02), templates='44'),
+    # Several templates from one invocation
+    'concurrent': dict(server=dict(repeat=200, foreign_ratio=1), templates='44, 45, 46, 47, 48, 49'),
+}
+
+# Runs main.py and records the peak RSS of the action process itself
+ACTION_WRAPPER = '''
+import atexit, resource, runpy, sys
+rss_file = sys.argv[1]
+atexit.register(lambda: open(rss_file, "w").write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+sys.argv = ["main.py"]
+runpy.run_path("main.py", run_name="__main__")
+'''
+
+requires_benchmarks = pytest.mark.skipif(
+    not os.environ.get('SEMAPHORE_BENCHMARKS'), reason='set SEMAPHORE_BENCHMARKS=1 to run the benchmark suite'
+)
+
+
+def load_baselines():
+    try:
+        with open(BASELINES_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(scenario, metrics):
+    baselines = load_baselines()
+    baselines[scenario] = metrics
+    with open(BASELINES_FILE, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+async def run_action(server, templates):
+    """Run the action against ``server`` and return its exit code, exit time, peak RSS in KiB and run metrics"""
+    with tempfile.TemporaryDirectory() as workdir:
+        rss_file = os.path.join(workdir, 'rss')
+        metrics_file = os.path.join(workdir, 'metrics.json')
+        env = dict(
+            os.environ,
+            INPUT_MYINPUT=templates,
+            INPUT_API_KEY='benchmark',
+            INPUT_API_URL=server.api_url,
+            INPUT_WS_API_URL=server.ws_api_url,
+            INPUT_PROJECT_ID='1',
+            INPUT_MAX_PARALLEL='10',
+            INPUT_METRICS_FILE=metrics_file,
+            GITHUB_OUTPUT=os.path.join(workdir, 'github_output'),
+        )
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', ACTION_WRAPPER, rss_file,
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=asyncio.subprocess.DEVNULL,
+        )
+        returncode = await process.wait()
+        exited_at = time.monotonic()
+        with open(rss_file, 'r') as f:
+            peak_rss_kb = int(f.read())
+        with open(metrics_file, 'r') as f:
+            run_metrics = json.load(f)
+    return returncode, exited_at, peak_rss_kb, run_metrics
+
+
+@requires_benchmarks
+@pytest.mark.parametrize('scenario', sorted(SCENARIOS))
+@pytest.mark.asyncio
+async def test_benchmark(scenario):
+    """Benchmark one scenario and compare it to its stored baseline"""
+    config = SCENARIOS[scenario]
+    async with FakeSemaphoreServer(**config['server']) as server:
+        started = time.monotonic()
+        returncode, exited_at, peak_rss_kb, run_metrics = await run_action(server, config['templates'])
+
+    assert returncode == 0
+    tasks = list(server.tasks.values())
+    assert tasks and all(task['terminal_at'] for task in tasks)
+    first_created = min(task['created_at'] for task in tasks)
+    last_terminal = max(task['terminal_at'] for task in tasks)
+    metrics = {
+        # frames the action's websocket reader took in, not what the server managed to send
+        'messages_per_second': round(run_metrics['counters']['messages_received']
+                                     / max(last_terminal - first_created, 1e-6)),
+        'terminal_to_exit_seconds': round(exited_at - last_terminal, 3),
+        'wall_seconds': round(exited_at - started, 3),
+        'peak_rss_kb': peak_rss_kb,
+        'rest_calls_per_task': round(sum(server.rest_calls.values()) / len(tasks), 2),
+    }
+    print(f"\n{scenario}: {json.dumps(metrics)}")
+
+    if os.environ.get('BENCHMARK_UPDATE_BASELINES'):
+        save_baseline(scenario, metrics)
+        return
+
+    baseline = load_baselines().get(scenario)
+    # a missing baseline must not pass as "no regression"
+    assert baseline is not None, (
+        f'no stored baseline for {scenario} in {os.path.basename(BASELINES_FILE)}; '
+        f'record one with BENCHMARK_UPDATE_BASELINES=1 (make benchmark-baseline) and commit it'
+    )
+    regressions = []
+    for name, value in metrics.items():
+        if name not in baseline or name == 'wall_seconds':
+            continue
+        if name in HIGHER_IS_BETTER:
+            regressed = value < baseline[name] * (1 - TOLERANCE)
+        else:
+            regressed = value > baseline[name] * (1 + TOLERANCE) and value - baseline[name] > 0.05
+        if regressed:
+            regressions.append(f'{name}: {value} (baseline {baseline[name]})')
+    assert not regressions, f'{scenario} regressed: ' + ', '.join(regressions)
+
+
+@pytest.mark.asyncio
+async def test_fake_server_replays_recording():
+    """Test the fake server creates tasks over REST and exposes their output and status"""
+    async with FakeSemaphoreServer(repeat=3) as server:
+        request = urllib.request.Request(
+            server.api_url + '/project/1/tasks', data=json.dumps({'template_id': 44}).encode(), method='POST'
+        )
+        task = json.loads(await asyncio.to_thread(lambda: urllib.request.urlopen(request).read()))
+        while server.tasks[task['id']]['terminal_at'] is None:
+            await asyncio.sleep(0.01)
+        status_url = f"{server.api_url}/project/1/tasks/{task['id']}"
+        status = json.loads(await asyncio.to_thread(lambda: urllib.request.urlopen(status_url).read()))
+        output = json.loads(await asyncio.to_thread(lambda: urllib.request.urlopen(status_url + '/output').read()))
+
+    assert status['status'] == 'success'
+    assert len(output) == 3 * sum(msg['type'] == 'log' for msg in REAL_WEBSOCKET_MESSAGES)
+    assert server.rest_calls == {'POST tasks': 1, 'GET task': 1, 'GET output': 1}
@@ -7,9 +7,16 @@ Tests all functionality using real API response data
 import json
 import os
 import pytest
+import subprocess
+import sys
 import tempfile
+import time
 from unittest.mock import Mock, patch, AsyncMock
 
+# Cumulative `python -X importtime -c "import main"` budget, in microseconds: about 1.5x the
+# 80-90ms measured from precompiled bytecode, as the image runs it
+IMPORT_TIME_BUDGET_US = 130_000
+
 # Test environment setup
 TEST_ENV = {
     'INPUT_API_KEY': 'test_api_key_12345',
@@ -117,7 +124,45 @@ def test_github_action_output_writing(mock_env, temp_output_file):
     with open(temp_output_file, 'r') as f:
         content = f.read()
     
-    assert content == 'testOutput=testValue'
+    assert content == 'testOutput=testValue\n'
+
+def test_github_output_writer_coalesces_deferred_values(mock_env, temp_output_file):
+    """Test deferred outputs keep only the latest value and multiline values use a delimiter"""
+    import main
+
+    writer = main.GithubOutputWriter(temp_output_file)
+    for index in range(1000):
+        writer.set('myOutput', json.dumps({'line': index}))
+    writer.set('tail', 'first line\nsecond line')
+    writer.close()
+
+    with open(temp_output_file, 'r') as f:
+        lines = f.read().splitlines()
+
+    assert lines[0] == 'myOutput={"line": 999}'
+    assert lines[1].startswith('tail<<ghadelimiter_')
+    assert lines[2:4] == ['first line', 'second line']
+    assert lines[4] == lines[1].split('<<', 1)[1]
+
+def test_github_output_writer_spills_oversized_values(mock_env, temp_output_file, tmp_path, capsys):
+    """Test values above the size cap are written to a workspace file and only its relative path is published"""
+    import main
+
+    writer = main.GithubOutputWriter(temp_output_file, max_value_bytes=16, workspace=str(tmp_path))
+    writer.write('myOutput', 'x' * 100)
+    # a workspace that cannot take the file truncates the value instead
+    writer.workspace = str(tmp_path / '.semaphore-outputs' / 'semaphore-output-myOutput.txt')
+    writer.write('log_tail', 'y' * 100)
+    writer.close()
+
+    with open(temp_output_file, 'r') as f:
+        lines = f.read().splitlines()
+
+    assert lines[0] == 'myOutput=.semaphore-outputs/semaphore-output-myOutput.txt'
+    with open(tmp_path / '.semaphore-outputs' / 'semaphore-output-myOutput.txt', 'r') as f:
+        assert f.read() == 'x' * 100
+    assert lines[1] == 'log_tail=' + 'y' * 16
+    assert '::warning title=Output truncated::Could not write output log_tail' in capsys.readouterr().out
 
 def test_ansi_escape_regex(mock_env):
     """Test ANSI escape sequence removal"""
@@ -127,6 +172,138 @@ def test_ansi_escape_regex(mock_env):
     cleaned = main.ansi_escape.sub('', test_string)
     assert cleaned == 'Red Text Normal Text'
 
+def test_log_sink_prints_only_output_text(mock_env):
+    """Test the log sink prints output text, strips ANSI in clean mode and keeps it in raw mode"""
+    import io
+    import main
+
+    stream = io.StringIO()
+    sink = main.LogSink(stream=stream)
+    sink.write({'type': 'log', 'task_id': 1011, 'output': '\x1B[31mfatal\x1B[0m: [beta_host]'})
+    sink.write({'type': 'update', 'task_id': 1011, 'status': 'running', 'output': ''})
+    sink.write({'type': 'log', 'task_id': 1011, 'output': ''})
+    assert stream.getvalue() == ''
+    sink.flush()
+    assert stream.getvalue() == 'fatal: [beta_host]\nTask 1011 status: running\n'
+
+    raw_stream = io.StringIO()
+    raw_sink = main.LogSink(stream=raw_stream, mode='raw')
+    raw_sink.write({'type': 'log', 'task_id': 1011, 'output': '\x1B[31mred\x1B[0m'})
+    raw_sink.flush()
+    assert raw_stream.getvalue() == '\x1B[31mred\x1B[0m\n'
+
+def test_log_tail_keeps_last_lines_and_failures(mock_env):
+    """Test the log tail and failure extraction stay bounded however long the playbook runs"""
+    import main
+
+    tail = main.LogTail(lines=3, max_failures=2, max_line_chars=60)
+    for i in range(10000):
+        tail.feed(f'ok: [web{i}]')
+    tail.feed('fatal: [web1]: UNREACHABLE! => {"changed": false, "msg": "' + 'x' * 500 + '"}')
+    tail.feed('\x1b[0;31mfatal: [web2]: FAILED! => {"msg": "boom"}\x1b[0m\nPLAY RECAP')
+    tail.feed('ERROR! the role \'missing\' was not found')
+
+    assert list(tail.lines)[-2:] == ['PLAY RECAP', "ERROR! the role 'missing' was not found"]
+    assert len(tail.lines) == 3
+    assert tail.failure_count == 3
+    assert list(tail.failures) == ['fatal: [web2]: FAILED! => {"msg": "boom"}', "ERROR! the role 'missing' was not found"]
+    assert all(len(line) <= 63 for line in tail.lines)
+
+    assert main.capped_text(['a' * 10, 'b' * 10, 'c' * 10], 25) == 'b' * 10 + '\n' + 'c' * 10
+    assert main.capped_text(['a' * 10], 5) == ''
+
+def test_log_archive_indexes_play_and_task_offsets(mock_env, tmp_path):
+    """Test the log archive can be read from any indexed PLAY/TASK header on its own"""
+    import gzip
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES
+
+    main.task_archives.pop(1042, None)
+    with patch.dict(os.environ, {'INPUT_LOG_ARCHIVE_DIR': str(tmp_path)}):
+        archive = main.task_archive(1042)
+    for msg in REAL_WEBSOCKET_MESSAGES:
+        archive.write(main.TaskMessage.decode(json.dumps(msg)))
+    archive.write({'type': 'log', 'task_id': 1042, 'output': '\x1b[0;32mTASK [deploy app] ****\x1b[0m'})
+    archive.write({'type': 'log', 'task_id': 1042, 'output': 'changed: [web1]'})
+    archive.close()
+
+    assert archive.path == str(tmp_path / 'semaphore-task-1042.jsonl.gz')
+    with gzip.open(archive.path, 'rt') as f:
+        assert len(f.readlines()) == len(REAL_WEBSOCKET_MESSAGES) + 2
+    with open(archive.index_path) as f:
+        index = [json.loads(line) for line in f]
+    assert index[-1]['kind'] == 'TASK' and index[-1]['name'] == 'deploy app'
+    assert index[-1]['line'] == len(REAL_WEBSOCKET_MESSAGES)
+    with open(archive.path, 'rb') as f:
+        f.seek(index[-1]['offset'])
+        lines = [json.loads(line)['output'] for line in gzip.open(f)]
+    assert lines == ['\x1b[0;32mTASK [deploy app] ****\x1b[0m', 'changed: [web1]']
+
+def test_ansible_profile_times_tasks_and_hosts(mock_env):
+    """Test the profile times each Ansible task and host from the log timestamps"""
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES
+
+    main.task_profiles.pop(1011, None)
+    profile = main.task_profile(1011)
+    for msg in REAL_WEBSOCKET_MESSAGES:
+        if msg['type'] == 'log':
+            profile.feed(msg['output'], msg['time'])
+
+    assert profile.recap
+    assert profile.tasks == [{'play': 'all', 'task': 'Gathering Facts', 'handler': False, 'seconds': 167.833,
+                              'hosts': 2, 'slowest_host': 'beta_host', 'slowest_host_seconds': 2.455}]
+    assert profile.to_dict()['hosts'] == {'beta_host': 2.455, 'beta_php_worker': 2.227}
+
+    unfinished = main.AnsibleProfile()
+    unfinished.feed('PLAY [db] ***', '2024-03-25T13:00:00Z')
+    unfinished.feed('TASK [migrate] ***', '2024-03-25T13:00:01Z')
+    unfinished.feed('fatal: [db1]: FAILED! => {}', '2024-03-25T13:00:31Z')
+    unfinished.finish()
+    assert unfinished.slowest(1) == [{'play': 'db', 'task': 'migrate', 'handler': False, 'seconds': 30.0,
+                                      'hosts': 1, 'slowest_host': 'db1', 'slowest_host_seconds': 30.0}]
+
+    rows = main.slow_tasks([{'template_id': 44, 'task_id': 1011}], top=5)
+    assert [row['task'] for row in rows] == ['Gathering Facts']
+    assert '| 44 | 1011 | all | Gathering Facts | 167.833s | 2 | beta_host (2.455s) |' in main.format_slow_tasks(rows)
+
+def test_log_sink_throughput(mock_env):
+    """Test the batched log sink prints what a print per message did, in a write per batch_lines lines"""
+    import copy
+    import io
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES
+
+    # half the lines coloured, so the sink has escapes to strip
+    fixtures = [dict(msg, output=f"\x1b[0;32m{msg['output']}\x1b[0m") if msg.get('output') and i % 2 else msg
+                for i, msg in enumerate(REAL_WEBSOCKET_MESSAGES)] * 500
+
+    legacy_stream = io.StringIO()
+    started = time.perf_counter()
+    for log_item in copy.deepcopy(fixtures):
+        if log_item.get('type') == 'update':
+            print(f"Task {log_item['task_id']} status: {log_item['status']}", file=legacy_stream, flush=True)
+        elif log_item.get('output'):
+            print(main.ansi_escape.sub('', log_item['output']).rstrip('\n'), file=legacy_stream, flush=True)
+    legacy_elapsed = time.perf_counter() - started
+
+    writes = []
+    sink_stream = io.StringIO()
+    sink_stream.write = lambda text: writes.append(text) or len(text)
+    sink = main.LogSink(stream=sink_stream, batch_lines=256)
+    started = time.perf_counter()
+    for log_item in copy.deepcopy(fixtures):
+        sink.write(log_item)
+    sink.flush()
+    sink_elapsed = time.perf_counter() - started
+
+    print(f"log sink: {len(fixtures) / sink_elapsed:.0f} msg/s, "
+          f"print per message: {len(fixtures) / legacy_elapsed:.0f} msg/s")
+    assert ''.join(writes) == legacy_stream.getvalue()
+    assert '\x1b' not in ''.join(writes)
+    assert sink.lines == legacy_stream.getvalue().count('\n')
+    assert len(writes) == -(-sink.lines // 256)
+
 def test_print_hi_function(mock_env):
     """Test the print_hi utility function"""
     import main
@@ -191,6 +368,126 @@ def test_start_task_api_exception(mock_project_api, mock_api_client, mock_env):
         assert "Exception when calling ProjectApi->project_project_id_tasks_post" in error_msg
         assert "API Error" in error_msg
 
+def test_retry_policy_backs_off_and_honors_retry_after(mock_env):
+    """Test 429/5xx responses are retried, waiting for Retry-After when given, within the time budget"""
+    import main
+    import semaphore_client
+
+    throttled = semaphore_client.ApiException(status=429)
+    throttled.headers = {'Retry-After': '3'}
+    unavailable = semaphore_client.ApiException(status=502)
+    sleeps = []
+    policy = main.RetryPolicy(budget=60, sleep=sleeps.append)
+    request = Mock(side_effect=[throttled, unavailable, {'id': 5205}])
+
+    assert policy.call(request, 1, 5205) == {'id': 5205}
+    assert request.call_count == 3
+    assert sleeps[0] == 3.0 and 0 <= sleeps[1] <= 1.0
+
+    request = Mock(side_effect=semaphore_client.ApiException(status=404))
+    with pytest.raises(semaphore_client.ApiException):
+        policy.call(request)
+    assert request.call_count == 1
+
+    slow_down = semaphore_client.ApiException(status=503)
+    slow_down.headers = {'Retry-After': '120'}
+    request = Mock(side_effect=slow_down)
+    with pytest.raises(semaphore_client.ApiException):
+        main.RetryPolicy(budget=60, sleep=sleeps.append).call(request)
+    assert request.call_count == 1
+
+@patch('main.api_retry')
+def test_start_task_does_not_start_twice_after_gateway_error(mock_api_retry, mock_env):
+    """Test a POST that failed with 502 after Semaphore created the task picks that task up instead of re-posting"""
+    import datetime
+    import main
+    import semaphore_client
+
+    mock_api_retry.return_value = main.RetryPolicy(sleep=lambda delay: None)
+    created = dict(get_real_task_creation_response(), id=5206,
+                   created=datetime.datetime.now(datetime.timezone.utc).isoformat())
+    older = dict(get_real_task_creation_response(), id=5100, created='2025-01-01T00:00:00Z')
+    api_instance = Mock()
+    api_instance.project_project_id_tasks_post.side_effect = semaphore_client.ApiException(status=502)
+    api_instance.project_project_id_tasks_last_get.return_value = [created, older]
+
+    assert main.start_task(44, 1, api_instance) == 5206
+    api_instance.project_project_id_tasks_post.assert_called_once()
+    api_instance.project_project_id_tasks_last_get.assert_called_once_with(1)
+
+    # a create refused with 429 is posted again, but counted once, its second POST under retries
+    api_instance.project_project_id_tasks_post.side_effect = [semaphore_client.ApiException(status=429),
+                                                              dict(get_real_task_creation_response(), id=5207)]
+    before = main.rest_requests.copy()
+    assert main.start_task(44, 1, api_instance) == 5207
+    counted = main.rest_requests - before
+    assert (counted['create'], counted['retries']) == (1, 1)
+
+@patch('main.api_retry')
+def test_start_task_after_gateway_error_ignores_sibling_shards(mock_api_retry, mock_env):
+    """Test the created-task lookup only adopts a task with this shard's limit and environment, and only once"""
+    import datetime
+    import main
+    import semaphore_client
+
+    mock_api_retry.return_value = main.RetryPolicy(sleep=lambda delay: None)
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    sibling = dict(get_real_task_creation_response(), id=5402, created=now, limit='web[1:2]')
+    other_env = dict(get_real_task_creation_response(), id=5403, created=now, limit='web[0:1]',
+                     environment='{"tag": "v2"}')
+    own = dict(get_real_task_creation_response(), id=5401, created=now, limit='web[0:1]')
+    api_instance = Mock()
+    api_instance.project_project_id_tasks_post.side_effect = semaphore_client.ApiException(status=502)
+    api_instance.project_project_id_tasks_last_get.return_value = [sibling, other_env, own]
+
+    assert main.start_task(44, 1, api_instance, limit='web[0:1]') == 5401
+    # the task is claimed now, so another lookup for the same shard does not adopt it again
+    task = Mock(template_id=44, environment='{}', arguments=None, limit='web[0:1]')
+    since = datetime.datetime.now(datetime.timezone.utc)
+    assert main.find_created_task(api_instance, 1, task, since) is None
+
+def test_start_task_attaches_to_unfinished_identical_task(mock_env):
+    """Test reuse_task joins a queued task of the same template and environment instead of posting another"""
+    import main
+
+    waiting = dict(get_real_task_creation_response(), id=5301, status='waiting')
+    running = dict(get_real_task_creation_response(), id=5300, status='running')
+    other_env = dict(get_real_task_creation_response(), id=5302, status='waiting', environment='{"tag": "v2"}')
+    other_template = dict(get_real_task_creation_response(), id=5303, status='waiting', template_id=45)
+    api_instance = Mock()
+    api_instance.project_project_id_tasks_last_get.return_value = [other_template, other_env, running, waiting]
+    api_instance.project_project_id_tasks_post.return_value = get_real_task_creation_response()
+
+    with patch.dict(os.environ, {'INPUT_REUSE_TASK': 'waiting'}):
+        assert main.start_task(44, 1, api_instance) == 5301
+    api_instance.project_project_id_tasks_post.assert_not_called()
+
+    # 5301 is taken by this run now, and running tasks are only joined in 'running' mode
+    with patch.dict(os.environ, {'INPUT_REUSE_TASK': 'waiting'}):
+        assert main.start_task(44, 1, api_instance) == 5205
+    with patch.dict(os.environ, {'INPUT_REUSE_TASK': 'running'}):
+        assert main.start_task(44, 1, api_instance) == 5300
+    assert api_instance.project_project_id_tasks_post.call_count == 1
+
+def test_daemon_runs_reuse_each_others_tasks(mock_env):
+    """Test separate runs served by the daemon may attach to one task, but a run never gets a task twice"""
+    import main
+
+    waiting = dict(get_real_task_creation_response(), id=5311, status='waiting')
+    api_instance = Mock()
+    api_instance.project_project_id_tasks_last_get.return_value = [waiting]
+    api_instance.project_project_id_tasks_post.return_value = dict(get_real_task_creation_response(), id=5312)
+
+    assert main.start_task(44, 1, api_instance, reuse_task='waiting', run='job-a') == 5311
+    assert main.start_task(44, 1, api_instance, reuse_task='waiting', run='job-b') == 5311
+    assert main.start_task(44, 1, api_instance, reuse_task='waiting', run='job-a') == 5312
+    assert api_instance.project_project_id_tasks_post.call_count == 1
+
+    main.forget_task(5311, run='job-a')
+    assert main._claimed_task_ids[None, 5311] == {'job-b'}
+    main.forget_task(5311, run='job-b')
+    assert (None, 5311) not in main._claimed_task_ids
+
 @patch('websockets.connect')
 @patch('main.set_github_action_output')
 @pytest.mark.asyncio
@@ -228,7 +525,8 @@ async def test_websocket_polling_success(mock_set_output, mock_websocket_connect
 @patch('websockets.connect')
 @pytest.mark.asyncio
 async def test_websocket_connection_closed(mock_websocket_connect, mock_env):
-    """Test WebSocket polling with connection closed"""
+    """Test a dropped websocket falls back to a REST status check instead of exiting blind"""
+    import io
     import main
     from websockets import ConnectionClosed
     
@@ -239,12 +537,354 @@ async def test_websocket_connection_closed(mock_websocket_connect, mock_env):
     
     # Setup API instance mock
     mock_api_instance = Mock()
+    mock_task_response = Mock()
+    mock_task_response.to_dict.return_value = {'status': 'success', 'id': 1011}
+    mock_api_instance.project_project_id_tasks_task_id_get.return_value = mock_task_response
     
     # Run the test - should not raise exception
-    await main.poll_task_updates(1011, mock_api_instance, 1)
+    stream = io.StringIO()
+    with patch('main.log_sink', return_value=main.LogSink(stream=stream)):
+        status = await main.poll_task_updates(1011, mock_api_instance, 1)
     
-    # Verify WebSocket connection was attempted
-    mock_websocket_connect.assert_called_once()
+    # Verify WebSocket connection was attempted and the outcome came from REST
+    assert mock_websocket_connect.called
+    assert status == 'success'
+    mock_api_instance.project_project_id_tasks_task_id_get.assert_called_with(1, 1011)
+    # the REST status is reported through the log sink like a websocket update
+    assert stream.getvalue() == 'Task 1011 status: success\n'
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_websocket_reconnect_backfills_missed_logs(mock_websocket_connect, mock_env):
+    """Test a reconnect backfills missed log lines from REST exactly once"""
+    import io
+    import main
+    from websockets import ConnectionClosed
+    from test_data import REAL_WEBSOCKET_MESSAGES
+
+    before_drop = REAL_WEBSOCKET_MESSAGES[:5]
+    after_reconnect = REAL_WEBSOCKET_MESSAGES[9:]
+    first_socket = AsyncMock()
+    first_socket.recv.side_effect = [json.dumps(msg) for msg in before_drop] + [ConnectionClosed(None, None)]
+    second_socket = AsyncMock()
+    second_socket.recv.side_effect = [json.dumps(msg) for msg in after_reconnect]
+    mock_websocket_connect.return_value.__aenter__.side_effect = [first_socket, second_socket]
+
+    mock_api_instance = Mock()
+    mock_task_response = Mock()
+    mock_task_response.to_dict.return_value = {'status': 'running', 'id': 1011}
+    mock_api_instance.project_project_id_tasks_task_id_get.return_value = mock_task_response
+    mock_api_instance.project_project_id_tasks_task_id_output_get.return_value = [
+        {'task_id': 1011, 'time': msg['time'], 'output': msg['output']}
+        for msg in REAL_WEBSOCKET_MESSAGES[:10] if msg['type'] == 'log'
+    ]
+
+    stream = io.StringIO()
+    router = main.TaskStreamRouter(backoff_base=0)
+    await router.start()
+    try:
+        with patch('main.log_sink', return_value=main.LogSink(stream=stream)):
+            status = await main.poll_task_updates(1011, mock_api_instance, 1, router=router)
+    finally:
+        await router.close()
+
+    assert status == 'success'
+    assert router.reconnects == 1
+    printed = stream.getvalue().splitlines()
+    for msg in REAL_WEBSOCKET_MESSAGES:
+        if msg['type'] == 'log':
+            assert printed.count(msg['output'].rstrip('\n')) == 1, msg['output']
+
+@patch('websockets.connect')
+@patch('main.set_github_action_output')
+@pytest.mark.asyncio
+async def test_websocket_status_lookup_does_not_block_recv(mock_set_output, mock_websocket_connect, mock_env):
+    """Test a quiet task is checked over REST in a worker thread while frames keep being read"""
+    import asyncio
+    import main
+    from test_data import WEBSOCKET_DIFFERENT_TASK_MESSAGES
+
+    frames = [json.dumps(msg) for msg in WEBSOCKET_DIFFERENT_TASK_MESSAGES * 3]
+
+    async def recv():
+        if frames:
+            await asyncio.sleep(0.1)
+            return frames.pop(0)
+        await asyncio.Event().wait()
+
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = recv
+
+    def slow_status_lookup(project_id, task_id):
+        time.sleep(0.3)
+        mock_task_response = Mock()
+        mock_task_response.to_dict.return_value = {'status': 'success', 'id': task_id}
+        return mock_task_response
+
+    mock_api_instance = Mock()
+    mock_api_instance.project_project_id_tasks_task_id_get.side_effect = slow_status_lookup
+
+    router = main.TaskStreamRouter()
+    await router.start()
+    try:
+        status = await main.poll_task_updates(1011, mock_api_instance, 1, router=router, status_interval=0.05)
+    finally:
+        await router.close()
+
+    assert status == 'success'
+    # Foreign frames kept being read while the lookup slept in its thread
+    assert router.dropped == 3
+    assert mock_api_instance.project_project_id_tasks_task_id_get.call_count == 1
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_task_stream_router_dispatches_by_task_id(mock_websocket_connect, mock_env):
+    """Test one websocket feeds every waiter of a task and drops unsubscribed tasks"""
+    import asyncio
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES, WEBSOCKET_DIFFERENT_TASK_MESSAGES
+
+    frames = [json.dumps(msg) for msg in WEBSOCKET_DIFFERENT_TASK_MESSAGES + REAL_WEBSOCKET_MESSAGES]
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = frames + [asyncio.CancelledError()]
+
+    router = main.TaskStreamRouter()
+    first = router.subscribe(1011)
+    second = router.subscribe(1011)
+    await router.start()
+    await asyncio.sleep(0)
+    await router.close()
+
+    assert mock_websocket_connect.call_count == 1
+    assert router.dropped == len(WEBSOCKET_DIFFERENT_TASK_MESSAGES)
+    assert first.qsize() == second.qsize() == len(REAL_WEBSOCKET_MESSAGES) + 1
+    assert first.get_nowait()['status'] == 'starting'
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_task_stream_router_bounds_waiter_queues(mock_websocket_connect, mock_env):
+    """Test a burst of output to a stalled waiter is coalesced or dropped but status updates always get through"""
+    import asyncio
+    import main
+
+    def log(i):
+        return json.dumps({'type': 'log', 'task_id': 1011, 'output': f'ok: [web{i}]', 'time': None})
+
+    update = json.dumps({'type': 'update', 'task_id': 1011, 'status': 'success'})
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = [log(i) for i in range(10000)] + [update, asyncio.CancelledError()]
+
+    with patch.dict(os.environ, {'INPUT_LOG_QUEUE_SIZE': '100'}):
+        router = main.TaskStreamRouter()
+    queue = router.subscribe(1011)
+    await router.start()
+    await asyncio.sleep(0)
+    await router.close()
+
+    items = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert len(items) == 102 and items[-1] is None
+    assert items[-2]['status'] == 'success'
+    assert queue.logs == 0
+    # the 100th message took lines until it hit the coalescing cap
+    merged = items[99]['output'].splitlines()
+    assert merged[0] == 'ok: [web99]' and queue.coalesced == len(merged) - 1
+    assert queue.coalesced + queue.dropped == 10000 - 100 and queue.dropped > 0
+    assert json.loads(str(items[99]))['output'] == items[99]['output']
+
+    dropping = main.MessageQueue(max_logs=1, overflow='drop')
+    for i in range(3):
+        dropping.put_nowait(main.TaskMessage.decode(log(i)))
+    dropping.put_nowait(main.STREAM_DISCONNECTED)
+    assert dropping.qsize() == 2 and dropping.dropped == 2 and dropping.coalesced == 0
+
+    # every subscriber's queue holds the same message, so coalescing in one must not change the others
+    full, roomy = main.MessageQueue(max_logs=1), main.MessageQueue(max_logs=10)
+    for i in range(3):
+        message = main.TaskMessage.decode(log(i))
+        full.put_nowait(message)
+        roomy.put_nowait(message)
+    assert full.get_nowait()['output'].splitlines() == ['ok: [web0]', 'ok: [web1]', 'ok: [web2]']
+    assert [roomy.get_nowait()['output'] for _ in range(3)] == ['ok: [web0]', 'ok: [web1]', 'ok: [web2]']
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_task_stream_router_filters_before_decoding(mock_websocket_connect, mock_env):
+    """Test untracked tasks' frames are dropped undecoded and tracked ones become compact TaskMessages"""
+    import asyncio
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES, WEBSOCKET_DIFFERENT_TASK_MESSAGES
+
+    frames = [json.dumps(msg) for msg in WEBSOCKET_DIFFERENT_TASK_MESSAGES * 50 + REAL_WEBSOCKET_MESSAGES]
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = frames + [asyncio.CancelledError()]
+
+    router = main.TaskStreamRouter()
+    queue = router.subscribe(1011)
+    with patch.object(main.TaskMessage, 'decode', wraps=main.TaskMessage.decode) as mock_decode:
+        await router.start()
+        await asyncio.sleep(0)
+        await router.close()
+
+    assert mock_decode.call_count == len(REAL_WEBSOCKET_MESSAGES)
+    assert router.dropped == 50 * len(WEBSOCKET_DIFFERENT_TASK_MESSAGES)
+    message = queue.get_nowait()
+    assert isinstance(message, main.TaskMessage) and not hasattr(message, '__dict__')
+    assert str(message) == frames[-len(REAL_WEBSOCKET_MESSAGES)]
+
+    log = main.TaskMessage.decode(json.dumps({'type': 'log', 'task_id': 1011, 'project_id': 1,
+                                              'output': '\x1b[0;32mok: [host]\x1b[0m', 'time': None}))
+    assert log.get('status', '') == '' and log.get('project_id') == 1
+    main.LogSink(stream=Mock()).write(log)
+    assert json.loads(str(log)) == {'type': 'log', 'task_id': 1011, 'project_id': 1, 'output': 'ok: [host]',
+                                    'time': None}
+    assert main.frame_task_id(json.dumps({'output': '{"task_id": 7}', 'task_id': 1011})) == 1011
+
+def test_next_poll_interval_adapts(mock_env):
+    """Test REST polling is fast at first, backs off, and tightens towards the expected end"""
+    import main
+
+    assert main.next_poll_interval(0) == 1.0
+    assert main.next_poll_interval(120) == 12.0
+    assert main.next_poll_interval(3600) == 30.0
+    assert main.next_poll_interval(200, expected_duration=240) == 10.0
+    assert main.next_poll_interval(238, expected_duration=240) == 1.0
+    assert main.next_poll_interval(300, expected_duration=240) == 6.0
+
+@patch('main.set_github_action_output')
+@pytest.mark.asyncio
+async def test_poll_task_rest_prints_only_new_lines(mock_set_output, mock_env):
+    """Test REST polling waits for a terminal status and prints each log line once"""
+    import io
+    import main
+    from test_data import REAL_TASK_STATUS_RUNNING, REAL_TASK_STATUS_SUCCESS, REAL_WEBSOCKET_MESSAGES
+
+    logs = [msg for msg in REAL_WEBSOCKET_MESSAGES if msg['type'] == 'log']
+    statuses = [REAL_TASK_STATUS_RUNNING, REAL_TASK_STATUS_RUNNING, REAL_TASK_STATUS_SUCCESS]
+    mock_api_instance = Mock()
+    mock_api_instance.project_project_id_tasks_task_id_get.side_effect = [
+        Mock(to_dict=Mock(return_value=status)) for status in statuses
+    ]
+    mock_api_instance.project_project_id_tasks_task_id_output_get.side_effect = [logs[:3], logs[:7], logs]
+
+    main.rest_requests.clear()
+    stream = io.StringIO()
+    with patch('main.log_sink', return_value=main.LogSink(stream=stream)):
+        status = await main.poll_task_rest(5205, mock_api_instance, 1, min_interval=0.01)
+
+    assert status == 'success'
+    assert stream.getvalue().splitlines() == [msg['output'].rstrip('\n') for msg in logs]
+    assert main.rest_requests['status'] == 3
+    assert main.rest_requests['output'] == 3
+
+@patch('main.api_retry')
+@pytest.mark.asyncio
+async def test_poll_task_rest_keeps_polling_through_connection_errors(mock_api_retry, mock_env):
+    """Test a connection error that outlasts the retry budget is reported and the next poll carries on"""
+    import io
+    import main
+    import urllib3
+    from test_data import REAL_TASK_STATUS_SUCCESS
+
+    mock_api_retry.return_value = Mock(call=lambda func, *args, **kwargs: func(*args, **kwargs))
+    mock_api_instance = Mock()
+    mock_api_instance.project_project_id_tasks_task_id_get.side_effect = [
+        urllib3.exceptions.MaxRetryError(None, '/api/project/1/tasks/5205'),
+        Mock(to_dict=Mock(return_value=REAL_TASK_STATUS_SUCCESS)),
+    ]
+    mock_api_instance.project_project_id_tasks_task_id_output_get.return_value = []
+
+    with patch('main.log_sink', return_value=main.LogSink(stream=io.StringIO())):
+        status = await main.poll_task_rest(5205, mock_api_instance, 1, min_interval=0.01)
+
+    assert status == 'success'
+    assert mock_api_instance.project_project_id_tasks_task_id_get.call_count == 2
+
+@patch('main.api_retry')
+def test_template_duration_falls_back_to_no_eta_on_connection_errors(mock_api_retry, mock_env):
+    """Test a template lookup that never reaches Semaphore gives no ETA rather than failing the wait"""
+    import main
+    import urllib3
+
+    mock_api_retry.return_value = Mock(call=Mock(side_effect=urllib3.exceptions.MaxRetryError(None, '/api')))
+    assert main.get_template_duration(Mock(), 1, 44) is None
+
+@patch('main.poll_task_rest')
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_websocket_unreachable_falls_back_to_rest(mock_websocket_connect, mock_poll_rest, mock_env):
+    """Test an unreachable websocket switches waiting to REST polling"""
+    import main
+
+    mock_websocket_connect.return_value.__aenter__.side_effect = OSError("Connection refused")
+    mock_poll_rest.return_value = 'success'
+    mock_api_instance = Mock()
+
+    status = await main.poll_task_updates(1011, mock_api_instance, 1)
+
+    assert status == 'success'
+    mock_poll_rest.assert_called_once_with(1011, mock_api_instance, 1, log_prefix='', idle_timeout=None, server=None)
+
+    with pytest.raises(OSError):
+        await main.poll_task_updates(1011, mock_api_instance, 1, rest_fallback=False)
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_task_stream_router_replays_early_frames(mock_websocket_connect, mock_env):
+    """Test frames that arrive before the task id is known are replayed on subscribe"""
+    import asyncio
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES, WEBSOCKET_DIFFERENT_TASK_MESSAGES
+
+    frames = [json.dumps(msg) for msg in REAL_WEBSOCKET_MESSAGES[:3] + WEBSOCKET_DIFFERENT_TASK_MESSAGES]
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = frames + [asyncio.CancelledError()]
+
+    router = main.TaskStreamRouter(early_buffer=10)
+    await router.start()
+    await asyncio.sleep(0)
+    queue = router.subscribe(1011)
+    router.stop_buffering()
+    await router.close()
+
+    replayed = [queue.get_nowait() for _ in range(3)]
+    assert [msg['output'] for msg in replayed] == [msg['output'] for msg in REAL_WEBSOCKET_MESSAGES[:3]]
+    assert 1011 in router.first_log_at
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_task_stream_router_buffers_only_expected_tasks(mock_websocket_connect, mock_env):
+    """Test once buffering stops only announced tasks are kept, a bounded number of frames each"""
+    import asyncio
+    import main
+    from test_data import WEBSOCKET_DIFFERENT_TASK_MESSAGES
+
+    logs = [json.dumps({'type': 'log', 'task_id': 7001, 'output': f'line {i}', 'time': None}) for i in range(3)]
+    others = [json.dumps(msg) for msg in WEBSOCKET_DIFFERENT_TASK_MESSAGES]
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = logs + others + [asyncio.CancelledError()]
+
+    router = main.TaskStreamRouter(early_buffer=2, early_tasks=2)
+    router.expect(7001)
+    router.stop_buffering()
+    await router.start()
+    await asyncio.sleep(0)
+    await router.close()
+
+    # other tasks' frames were filtered without a timestamp being kept for them
+    assert router.dropped == len(others) and router.first_log_at == {}
+    queue = router.subscribe(7001)
+    assert [queue.get_nowait()['output'] for _ in range(2)] == ['line 1', 'line 2']
+    assert 7001 in router.first_log_at
+
+    for task_id in (7101, 7102, 7103):
+        router.expect(task_id)
+    assert list(router._early) == [7102, 7103]
 
 @patch('main.start_task')
 @patch('main.set_github_action_output')
@@ -263,9 +903,10 @@ def test_main_function_world_input(mock_set_output, mock_start_task, mock_env):
 @patch('main.start_task')
 @patch('main.set_github_action_output')
 @patch('main.poll_task_updates')
+@patch('main.open_task_router')
 @patch('semaphore_client.ApiClient')
 @patch('main.project_api.ProjectApi')
-def test_main_function_template_execution(mock_project_api, mock_api_client, mock_pool_updates, mock_set_output, mock_start_task, mock_env):
+def test_main_function_template_execution(mock_project_api, mock_api_client, mock_open_router, mock_pool_updates, mock_set_output, mock_start_task, mock_env):
     """Test main function with template ID input"""
     import main
     
@@ -274,15 +915,527 @@ def test_main_function_template_execution(mock_project_api, mock_api_client, moc
         mock_start_task.return_value = 5205
         mock_api_instance = Mock()
         mock_project_api.return_value = mock_api_instance
+        mock_router = Mock(first_log_at={5205: 0.0}, received=12, dropped=4, reconnects=0, bytes_received=2048,
+                           close=AsyncMock())
+        mock_open_router.return_value = mock_router
+        mock_pool_updates.return_value = 'success'
         
-        main.main()
+        result = main.main()
         
         # Verify task creation
-        mock_start_task.assert_called_with(44, 1)
-        mock_set_output.assert_called_with('myOutput', 'Hello 44')
+        mock_start_task.assert_called_with(44, 1, mock_api_instance, limit=None)
+        mock_set_output.assert_any_call('myOutput', 'Hello 44')
+        mock_set_output.assert_any_call('status', 'success')
+        assert result == 0
         
-        # Verify WebSocket polling
-        mock_pool_updates.assert_called_once_with(5205, mock_api_instance, 1)
+        # Verify WebSocket polling over the router opened alongside task creation
+        mock_open_router.assert_called_once_with('auto', 1000)
+        mock_pool_updates.assert_called_once_with(5205, mock_api_instance, 1, router=mock_router, log_prefix='',
+                                                  idle_timeout=None, server=None)
+        mock_router.stop_buffering.assert_called_once_with()
+
+        # Verify the run's metrics are published
+        metrics = json.loads(next(c.args[1] for c in mock_set_output.call_args_list if c.args[0] == 'metrics'))
+        assert metrics['counters']['messages_filtered'] >= 4
+        assert metrics['tasks'][0]['task_id'] == 5205
+
+        # As in v1 a single failed task leaves the step green unless fail_on_any_error is set
+        mock_pool_updates.return_value = 'error'
+        assert main.main() == 0
+        mock_set_output.assert_any_call('status', 'error')
+        with patch.dict(os.environ, {'INPUT_FAIL_ON_ANY_ERROR': 'true'}):
+            assert main.main() == 1
+
+def test_run_metrics_phases_and_exports(mock_env, tmp_path):
+    """Test queue wait and run time come from task timestamps and are exported as summary, JSON and Prometheus"""
+    import main
+
+    metrics = main.RunMetrics()
+    metrics.observe_task(5205, get_real_task_creation_response())
+    metrics.observe_task(5205, {'type': 'update', 'status': 'running', 'start': '2025-12-04T11:38:47.290584995+02:00'})
+    metrics.observe_task(5205, {'status': 'success', 'start': '2025-12-04T09:38:47Z', 'end': '2025-12-04T09:41:47Z'})
+    assert metrics.task_phases(5205) == {'queue_seconds': 3.709, 'run_seconds': 180.0}
+    assert metrics.task_phases(9999) == {'queue_seconds': None, 'run_seconds': None}
+
+    with metrics.span('start_task'):
+        pass
+    metrics.add_router(Mock(received=10, dropped=6, reconnects=1, bytes_received=4096))
+    snapshot = metrics.snapshot([{'template_id': 44, 'task_id': 5205, 'status': 'success', 'time_to_first_log': 0.4,
+                                  'create_seconds': 0.2, 'queue_seconds': 4.0, 'run_seconds': 180.0,
+                                  'overhead_seconds': 1.1}])
+    assert snapshot['spans']['start_task']['count'] == 1
+    assert snapshot['counters']['messages_filtered'] == 6
+    assert 'rest_calls' in snapshot['counters']
+
+    summary = tmp_path / 'summary.md'
+    with patch.dict(os.environ, {'GITHUB_STEP_SUMMARY': str(summary)}):
+        main.write_step_summary(snapshot)
+    assert '| 44 | 5205 | success | 0.2s | 4.0s | 180.0s | 1.1s | 0.4s |' in summary.read_text()
+
+    main.write_metrics_file(str(tmp_path / 'metrics.prom'), snapshot)
+    prom = (tmp_path / 'metrics.prom').read_text()
+    assert 'semaphore_action_task_phase_seconds{template="44",task="5205",status="success",phase="queue"} 4.0' in prom
+    assert 'semaphore_action_messages_received_total 10' in prom
+    main.write_metrics_file(str(tmp_path / 'metrics.json'), snapshot)
+    assert json.loads((tmp_path / 'metrics.json').read_text())['counters']['reconnects'] == 1
+
+def test_parse_template_ids(mock_env):
+    """Test template id lists, including JSON matrices, are parsed"""
+    import main
+
+    assert main.parse_template_ids('44') == [44]
+    assert main.parse_template_ids('44, 45\n49') == [44, 45, 49]
+    assert main.parse_template_ids('[[44, 45], [49]]') == [44, 45, 49]
+    assert main.parse_template_ids('44 45') == [44, 45]
+    assert main.parse_template_ids('03 update beta app from git, 49') == ['03 update beta app from git', 49]
+
+@patch('semaphore_client.ApiClient')
+@patch('main.project_api.ProjectApi')
+def test_template_cache_resolves_names(mock_project_api, mock_api_client, mock_env, tmp_path):
+    """Test template names resolve through one bulk refresh and are then served from disk"""
+    import main
+    import urllib3
+    from test_data import REAL_TEMPLATES_RESPONSE
+
+    mock_api_instance = Mock()
+    mock_project_api.return_value = mock_api_instance
+    mock_api_instance.project_project_id_templates_get.return_value = Mock(
+        data=json.dumps(REAL_TEMPLATES_RESPONSE).encode(), headers={'ETag': '"v1"'}
+    )
+
+    cache = main.TemplateCache(str(tmp_path), 'http://test-api.example.com:3000/api', 1)
+    assert main.resolve_template_ids(['03 update beta app from git', 49], 1, cache) == [44, 49]
+    assert mock_api_instance.project_project_id_templates_get.call_count == 1
+
+    # A later run reads the persisted file and needs no request at all
+    next_run = main.TemplateCache(str(tmp_path), 'http://test-api.example.com:3000/api', 1)
+    assert main.resolve_template_ids(['01 provision beta without git/db update for app'], 1, next_run) == [49]
+    assert mock_api_instance.project_project_id_templates_get.call_count == 1
+
+    # A miss refreshes once, conditionally on the stored ETag
+    with pytest.raises(ValueError):
+        main.resolve_template_ids(['no such template'], 1, next_run)
+    assert mock_api_instance.project_project_id_templates_get.call_count == 2
+    mock_api_client.return_value.__enter__.return_value.set_default_header.assert_called_with('If-None-Match', '"v1"')
+
+    # When Semaphore cannot be reached, cached names are still served and others fail with the error
+    mock_api_instance.project_project_id_templates_get.side_effect = urllib3.exceptions.MaxRetryError(None, '/api')
+    unreachable = main.TemplateCache(str(tmp_path), 'http://test-api.example.com:3000/api', 1, max_age=0)
+    with patch('main.api_retry', return_value=Mock(call=lambda func, *args, **kwargs: func(*args, **kwargs))):
+        assert main.resolve_template_ids(['03 update beta app from git'], 1, unreachable) == [44]
+        with pytest.raises(ValueError, match='Could not look up template'):
+            main.resolve_template_ids(['no such template'], 1, unreachable)
+
+@patch('websockets.connect')
+@patch('main.poll_task_updates')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_run_templates_respects_max_parallel(mock_start_task, mock_poll_updates, mock_websocket_connect, mock_env):
+    """Test several templates run concurrently but never more than max_parallel at once"""
+    import asyncio
+    import main
+
+    running = 0
+    peak = 0
+
+    async def fake_poll(task_id, api_instance, project_id, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return 'error' if task_id == 5049 else 'success'
+
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None: 5000 + template_id
+    mock_poll_updates.side_effect = fake_poll
+
+    results = await main.run_templates([44, 45, 46, 49], 1, Mock(), max_parallel=2)
+    assert mock_start_task.call_count == 4
+
+    assert peak == 2
+    # every waiter shares the single websocket connection
+    assert mock_websocket_connect.call_count == 1
+    assert [result['task_id'] for result in results] == [5044, 5045, 5046, 5049]
+    assert [result['status'] for result in results] == ['success', 'success', 'success', 'error']
+
+def test_duration_history_baselines_and_cache(mock_env, tmp_path):
+    """Test template baselines come from the project's recent tasks and are cached between runs"""
+    import main
+    import urllib3
+
+    def task(task_id, template_id, seconds, status='success'):
+        return {'id': task_id, 'template_id': template_id, 'status': status,
+                'start': '2024-03-25T13:00:00Z', 'end': f'2024-03-25T13:{seconds // 60:02d}:{seconds % 60:02d}Z'}
+
+    api_instance = Mock()
+    api_instance.project_project_id_tasks_last_get.return_value = [
+        task(1, 44, 100), task(2, 44, 120), task(3, 44, 110), task(4, 44, 500, 'error'), task(5, 45, 60),
+        {'id': 6, 'template_id': 44, 'status': 'running', 'start': '2024-03-25T13:00:00Z', 'end': None},
+    ]
+    history = main.DurationHistory(str(tmp_path), 'http://semaphore/api', 1, keep=3)
+    history.refresh(api_instance)
+    assert history.baseline(44) == {'samples': 3, 'p50_seconds': 110.0, 'p95_seconds': 120.0}
+    assert history.baseline(46) is None
+
+    history.add(44, 7, 130.0)
+    assert history.baseline(44) == {'samples': 3, 'p50_seconds': 120.0, 'p95_seconds': 130.0}
+    history.save()
+
+    cached = main.DurationHistory(str(tmp_path), 'http://semaphore/api', 1)
+    cached.refresh(api_instance)
+    assert api_instance.project_project_id_tasks_last_get.call_count == 1
+    assert cached.baseline(45) == {'samples': 1, 'p50_seconds': 60.0, 'p95_seconds': 60.0}
+
+    # a stale cache whose refresh cannot reach Semaphore keeps serving the cached runs
+    stale = main.DurationHistory(str(tmp_path), 'http://semaphore/api', 1, max_age=0)
+    api_instance.project_project_id_tasks_last_get.side_effect = urllib3.exceptions.MaxRetryError(None, '/api')
+    with patch('main.api_retry', return_value=Mock(call=lambda func, *args: func(*args))):
+        stale.refresh(api_instance)
+    assert stale.baseline(45) == {'samples': 1, 'p50_seconds': 60.0, 'p95_seconds': 60.0}
+
+@patch('websockets.connect')
+@patch('main.poll_task_updates')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_run_templates_flags_runs_slower_than_baseline(mock_start_task, mock_poll_updates, mock_websocket_connect,
+                                                              mock_env, tmp_path, capsys):
+    """Test a run over regression_factor times its template's p50 is flagged with a warning"""
+    import main
+
+    history = main.DurationHistory(str(tmp_path), 'http://semaphore/api', 1)
+    for task_id, seconds in enumerate([100, 110, 120]):
+        history.add(44, task_id, seconds)
+        history.add(45, task_id, seconds)
+
+    async def fake_poll(task_id, api_instance, project_id, **kwargs):
+        seconds = 200 if task_id == 6044 else 115
+        main.run_metrics.observe_task(task_id, {'start': '2024-03-25T13:00:00Z',
+                                                'end': f'2024-03-25T13:{seconds // 60:02d}:{seconds % 60:02d}Z'})
+        return 'success'
+
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None: 6000 + template_id
+    mock_poll_updates.side_effect = fake_poll
+
+    with patch('main._duration_history', history), patch.dict(os.environ, {'INPUT_REGRESSION_FACTOR': '1.5'}):
+        results = await main.run_templates([44, 45], 1, Mock())
+
+    assert [result['regression'] for result in results] == [True, False]
+    assert results[0]['baseline_p50_seconds'] == 110.0
+    assert '::warning title=Slow Semaphore task::[44] Task 6044 of template 44 ran 200s' in capsys.readouterr().out
+    assert history.baseline(44)['samples'] == 4
+
+@patch('main.forget_task')
+@patch('main.stop_task')
+@patch('main.poll_task_updates')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_daemon_runs_tasks_for_thin_clients(mock_start_task, mock_poll_updates, mock_stop_task, mock_forget_task,
+                                                  mock_env, tmp_path):
+    """Test a step started through the daemon gets the task's log, status and stop requests relayed"""
+    import asyncio
+    import main
+    from test_data import REAL_WEBSOCKET_MESSAGES
+
+    async def fake_poll(task_id, api_instance, project_id, router=None, idle_timeout=None, sink=None):
+        if task_id == 7045:
+            await asyncio.sleep(10)
+        for msg in REAL_WEBSOCKET_MESSAGES:
+            sink.write(main.TaskMessage.decode(json.dumps(dict(msg, task_id=task_id))))
+        sink.flush()
+        return 'success'
+
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None, reuse_task=None, run=None: \
+        7000 + template_id
+    mock_poll_updates.side_effect = fake_poll
+    router = Mock(first_log_at={})
+    socket_path = str(tmp_path / 'd.sock')
+    server = asyncio.ensure_future(main.SemaphoreDaemon(Mock(), router).serve(socket_path))
+    while not os.path.exists(socket_path):
+        await asyncio.sleep(0.01)
+    client = main.DaemonClient(socket_path)
+    try:
+        assert await client.available()
+        with patch('main.set_github_action_output') as mock_set_output:
+            results = await main.run_templates([44, 45], 1, None, daemon=client, timeout=0.5)
+    finally:
+        server.cancel()
+
+    assert [result['status'] for result in results] == ['success', 'timeout']
+    assert results[0]['time_to_first_log'] is not None
+    assert list(main.task_log(7044).lines)[-1].startswith('beta_php_worker')
+    assert main.task_profile(7044).recap
+    # relayed messages are published as the frames themselves, without the line's newline
+    outputs = [str(call[0][1]) for call in mock_set_output.call_args_list if call[0][0] == 'myOutput']
+    assert outputs and not any(output.endswith('\n') for output in outputs)
+    mock_stop_task.assert_called_once_with(mock_start_task.call_args_list[0][0][2], 1, 7045)
+    # the daemon forgets tasks it no longer follows
+    assert sorted(call[0] for call in mock_forget_task.call_args_list) == [(7044, router, client.run),
+                                                                           (7045, router, client.run)]
+
+@pytest.mark.asyncio
+async def test_forwarding_sink_waits_for_slow_clients(mock_env):
+    """Test a daemon waiter holds off once its client falls a buffer behind, until the client reads again"""
+    import asyncio
+    import socket
+    import main
+
+    ours, theirs = socket.socketpair()
+    # small kernel buffers, so what the client has not read stays in the transport
+    ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    theirs.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    theirs.setblocking(False)
+    _, writer = await asyncio.open_connection(sock=ours)
+    sink = main.ForwardingSink(writer, max_buffer=64 * 1024)
+    while not sink.backlogged:
+        sink.write({'type': 'log', 'output': 'x' * 1000})
+    drained = asyncio.ensure_future(sink.drain())
+    await asyncio.sleep(0.05)
+    assert not drained.done()
+
+    async def read_all():
+        while await asyncio.get_running_loop().sock_recv(theirs, 1 << 16):
+            pass
+
+    reading = asyncio.ensure_future(read_all())
+    await asyncio.wait_for(drained, 5)
+    assert not sink.backlogged
+    reading.cancel()
+    writer.close()
+    theirs.close()
+
+def test_parse_endpoints(mock_env):
+    """Test extra Semaphore servers are read from lines or JSON, defaulting the websocket URL and key"""
+    import main
+
+    endpoints = main.parse_endpoints('https://b.example.com/api/\n\nhttp://c:3000/api ws://c-ws:3000/api', 'key')
+    assert [(e.api_url, e.ws_api_url, e.api_key) for e in endpoints] == [
+        ('https://b.example.com/api', 'wss://b.example.com/api', 'key'),
+        ('http://c:3000/api', 'ws://c-ws:3000/api', 'key'),
+    ]
+    endpoints = main.parse_endpoints('[{"api_url": "http://d/api", "api_key": "other"}]', 'key')
+    assert (endpoints[0].ws_api_url, endpoints[0].api_key) == ('ws://d/api', 'other')
+    assert main.parse_endpoints('', 'key') == []
+    with pytest.raises(ValueError):
+        main.parse_endpoints('[{"ws_api_url": "ws://d/api"}]', 'key')
+
+@patch('main.get_template_duration', return_value=None)
+@patch('main.poll_task_rest')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_run_templates_picks_least_loaded_server(mock_start_task, mock_poll_rest, mock_duration, mock_env):
+    """Test tasks go to the server with the fewest queued tasks and fail over when creation fails"""
+    import main
+
+    def server(name, statuses):
+        api_instance = Mock(name=name)
+        api_instance.project_project_id_tasks_last_get.return_value = [{'status': status} for status in statuses]
+        return main.Endpoint(f'http://{name}/api', f'ws://{name}/api', 'key', api_instance)
+
+    servers = [server('a', ['running'] * 4 + ['success'] * 10), server('b', ['waiting']), server('c', ['running'] * 3)]
+    ids = iter([8001, 8002])
+
+    def fake_start(template_id, project_id, api_instance, limit=None, server=None):
+        return None if api_instance is servers[1].api_instance else next(ids)
+
+    async def fake_poll(task_id, api_instance, project_id, expected_duration, **kwargs):
+        return 'success'
+
+    mock_start_task.side_effect = fake_start
+    mock_poll_rest.side_effect = fake_poll
+    results = await main.run_templates([44, 45], 1, servers[0].api_instance, max_parallel=1, wait_mode='rest',
+                                       endpoints=main.EndpointPool(servers))
+
+    # b is emptiest but fails to create the task; c then has 3 + 1 queued and a's 4 come first
+    assert [result['endpoint'] for result in results] == ['http://c/api', 'http://a/api']
+    assert [result['task_id'] for result in results] == [8001, 8002]
+    assert [call[0][1] for call in mock_poll_rest.call_args_list] == [servers[2].api_instance, servers[0].api_instance]
+    assert all(s.api_instance.project_project_id_tasks_last_get.call_count == 1 for s in servers)
+
+@patch('main.get_template_duration', return_value=None)
+@patch('main.poll_task_rest')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_run_templates_keeps_same_task_id_on_two_servers_apart(mock_start_task, mock_poll_rest, mock_duration,
+                                                                     mock_env, tmp_path):
+    """Test two servers handing out the same task id get their own log tail and archive"""
+    import main
+
+    servers = [main.Endpoint(f'http://{name}:3000/api', f'ws://{name}:3000/api', 'key', Mock(name=name))
+               for name in ('a', 'b')]
+    for endpoint in servers:
+        endpoint.api_instance.project_project_id_tasks_last_get.return_value = []
+
+    async def fake_poll(task_id, api_instance, project_id, expected_duration, server=None, **kwargs):
+        archive = main.task_archive(task_id, server)
+        main.task_log(task_id, server).feed(f'output of {server}')
+        archive.write({'type': 'log', 'output': f'output of {server}'})
+        archive.close()
+        return 'success'
+
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None, server=None: 8100
+    mock_poll_rest.side_effect = fake_poll
+    with patch.dict(os.environ, {'INPUT_LOG_ARCHIVE_DIR': str(tmp_path)}):
+        results = await main.run_templates([44, 45], 1, servers[0].api_instance, max_parallel=1, wait_mode='rest',
+                                           endpoints=main.EndpointPool(servers))
+
+    assert sorted(result['endpoint'] for result in results) == ['http://a:3000/api', 'http://b:3000/api']
+    assert sorted(result['log_archive'] for result in results) == [
+        str(tmp_path / 'semaphore-task-a_3000_api-8100.jsonl.gz'),
+        str(tmp_path / 'semaphore-task-b_3000_api-8100.jsonl.gz'),
+    ]
+    assert list(main.task_log(8100, 'http://b:3000/api').lines) == ['output of http://b:3000/api']
+
+@patch('websockets.connect')
+@patch('main.poll_task_updates')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_run_templates_stops_tasks_on_deadline_and_cancel(mock_start_task, mock_poll_updates, mock_websocket_connect, mock_env):
+    """Test tasks still running at the deadline, or when the run is cancelled, are stopped on the server"""
+    import asyncio
+    import main
+
+    async def fake_poll(task_id, api_instance, project_id, **kwargs):
+        await asyncio.sleep(0.01 if task_id == 5044 else 10)
+        return 'success'
+
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None: 5000 + template_id
+    mock_poll_updates.side_effect = fake_poll
+    api_instance = Mock()
+
+    results = await main.run_templates([44, 45], 1, api_instance, timeout=0.2)
+    assert [result['status'] for result in results] == ['success', 'timeout']
+    api_instance.project_project_id_tasks_task_id_stop_post.assert_called_once_with(1, 5045)
+
+    api_instance.reset_mock()
+    run = asyncio.ensure_future(main.run_templates([46], 1, api_instance))
+    await asyncio.sleep(0.1)
+    run.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await run
+    api_instance.project_project_id_tasks_task_id_stop_post.assert_called_once_with(1, 5046)
+
+@patch('websockets.connect')
+@pytest.mark.asyncio
+async def test_poll_task_updates_idle_timeout_and_terminal_states(mock_websocket_connect, mock_env):
+    """Test a silent task times out and every Semaphore terminal status ends the wait"""
+    import asyncio
+    import main
+
+    async def silent():
+        await asyncio.sleep(10)
+
+    mock_websocket = AsyncMock()
+    mock_websocket_connect.return_value.__aenter__.return_value = mock_websocket
+    mock_websocket.recv.side_effect = silent
+    router = main.TaskStreamRouter()
+    await router.start()
+    with pytest.raises(asyncio.TimeoutError):
+        await main.poll_task_updates(1011, Mock(), 1, router=router, idle_timeout=0.05)
+    await router.close()
+
+    stopped = dict(get_real_websocket_messages()[-1], status='stopped')
+    mock_websocket.recv.side_effect = [json.dumps(stopped), asyncio.CancelledError()]
+    router = main.TaskStreamRouter()
+    await router.start()
+    assert await main.poll_task_updates(1011, Mock(), 1, router=router, idle_timeout=5) == 'stopped'
+    await router.close()
+
+def test_shard_limit_splits_hosts_and_groups(mock_env):
+    """Test a host list or a sized group is split into shards that together cover every host"""
+    import main
+
+    hosts = ','.join(f'web{i}' for i in range(1, 8))
+    assert main.shard_limit(hosts, 3) == ['web1,web2,web3', 'web4,web5', 'web6,web7']
+    assert main.shard_limit('web1 web2\n!web2', 4) == ['web1,!web2', 'web2,!web2']
+    assert main.shard_limit('webservers,&prod', 2, group_size=5) == ['webservers[0:2],&prod', 'webservers[3:4],&prod']
+    with pytest.raises(ValueError, match='shard_group_size'):
+        main.shard_limit('webservers', 4)
+    with pytest.raises(ValueError):
+        main.shard_limit('', 4)
+
+@patch('websockets.connect')
+@patch('main.poll_task_updates')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_sharded_template_runs_each_limit_and_merges(mock_start_task, mock_poll_updates, mock_websocket_connect, mock_env):
+    """Test every shard becomes its own task with its limit and the template fails if any shard does"""
+    import main
+
+    limits = main.shard_limit('web1,web2,web3,web4', 2)
+    task_ids = {limit: 6000 + index for index, limit in enumerate(limits)}
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None: task_ids[limit]
+    mock_poll_updates.side_effect = AsyncMock(side_effect=lambda task_id, *args, **kwargs: 'error' if task_id == 6001 else 'success')
+
+    results = await main.run_pipeline(main.shard_nodes([44], limits), 1, Mock())
+
+    assert [result['node'] for result in results] == ['44_shard1', '44_shard2']
+    assert [call.kwargs['limit'] for call in mock_start_task.call_args_list] == ['web1,web2', 'web3,web4']
+    merged = main.merge_shards(results)
+    assert len(merged) == 1
+    assert merged[0]['task_ids'] == [6000, 6001]
+    assert merged[0]['status'] == 'error'
+
+def test_parse_pipeline(mock_env, tmp_path):
+    """Test pipelines are read inline or from a file, ordered by dependencies and validated"""
+    import main
+
+    graph = {'smoke': {'template': 13, 'needs': ['database', 'app']}, 'provision': 10,
+             'database': {'template': 'Update database', 'needs': 'provision'}, 'app': {'template': 12, 'needs': ['provision']}}
+    nodes = main.parse_pipeline(json.dumps(graph))
+    assert list(nodes) == ['provision', 'database', 'app', 'smoke']
+    assert nodes['database'] == {'template': 'Update database', 'needs': ['provision']}
+    assert nodes['provision'] == {'template': 10, 'needs': []}
+
+    pipeline_file = tmp_path / 'release.json'
+    pipeline_file.write_text(json.dumps(graph))
+    assert main.parse_pipeline(str(pipeline_file)) == nodes
+
+    with pytest.raises(ValueError, match='unknown'):
+        main.parse_pipeline('{"app": {"template": 12, "needs": ["db"]}}')
+    with pytest.raises(ValueError, match='cycle'):
+        main.parse_pipeline('{"a": {"template": 1, "needs": ["b"]}, "b": {"template": 2, "needs": ["a"]}}')
+
+@patch('websockets.connect')
+@patch('main.poll_task_updates')
+@patch('main.start_task')
+@pytest.mark.asyncio
+async def test_run_pipeline_follows_dependencies(mock_start_task, mock_poll_updates, mock_websocket_connect, mock_env):
+    """Test nodes start once their dependencies succeed and are skipped when one fails"""
+    import asyncio
+    import main
+
+    events = []
+    durations = {5010: 0.01, 5011: 0.05, 5012: 0.02, 5013: 0.01, 5014: 0.01}
+
+    async def fake_poll(task_id, api_instance, project_id, **kwargs):
+        events.append(('start', task_id))
+        await asyncio.sleep(durations[task_id])
+        events.append(('end', task_id))
+        return 'error' if task_id == 5012 else 'success'
+
+    mock_start_task.side_effect = lambda template_id, project_id, api_instance, limit=None: 5000 + template_id
+    mock_poll_updates.side_effect = fake_poll
+    nodes = main.parse_pipeline(json.dumps({
+        'provision': 10,
+        'database': {'template': 11, 'needs': ['provision']},
+        'app': {'template': 12, 'needs': ['provision']},
+        'smoke': {'template': 13, 'needs': ['database', 'app']},
+        'migrate': {'template': 14, 'needs': ['database']},
+    }))
+
+    results = {result['node']: result for result in await main.run_pipeline(nodes, 1, Mock(), max_parallel=2)}
+
+    assert mock_websocket_connect.call_count == 1
+    assert events.index(('end', 5010)) < events.index(('start', 5011))
+    assert events.index(('end', 5010)) < events.index(('start', 5012))
+    assert events.index(('end', 5011)) < events.index(('start', 5014))
+    assert results['smoke']['status'] == 'skipped' and results['smoke']['task_id'] is None
+    # a skipped node reports the same fields as a task that ran
+    assert results['smoke'].keys() == results['migrate'].keys() and results['smoke']['regression'] is False
+    assert results['migrate']['status'] == 'success'
+    assert mock_start_task.call_count == 4
+    assert results['smoke']['needs'] == ['database', 'app']
+    assert main.critical_path(list(results.values())) == ['provision', 'database', 'migrate']
 
 def test_configuration_setup(mock_env):
     """Test Semaphore client configuration"""
@@ -299,6 +1452,26 @@ def test_configuration_setup(mock_env):
     assert config.api_key['bearer'] == 'test_api_key_12345'
     assert config.api_key_prefix['bearer'] == 'Bearer'
 
+def test_import_time_budget():
+    """Test importing main stays within the startup budget and defers heavy imports"""
+    import py_compile
+
+    # the Dockerfile precompiles main.py, so compiling it is no part of the startup being measured
+    py_compile.compile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), doraise=True)
+    env = {key: value for key, value in os.environ.items() if not key.startswith('INPUT_')}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys, main; print(",".join(m for m in ("semaphore_client", "websockets") if m in sys.modules))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True,
+    )
+
+    # No inputs, no client configuration and no third-party imports at import time
+    assert result.stdout.strip() == ''
+    main_line = [line for line in result.stderr.splitlines() if line.rstrip().endswith('| main')][-1]
+    cumulative_us = int(main_line.split('|')[1])
+    print(f"import main: {cumulative_us / 1000:.1f}ms (budget {IMPORT_TIME_BUDGET_US / 1000:.0f}ms)")
+    assert cumulative_us < IMPORT_TIME_BUDGET_US
+
 def test_multiple_github_outputs(mock_env, temp_output_file):
     """Test multiple GitHub output writes accumulate properly"""
     import main